@@ -28,22 +28,93 @@
 #
 
 
-import pika
-import random
 import json
 import requests
 import sys
+import threading
+import Queue
 from ConfigParser import SafeConfigParser
+from mbus_helpers import MessageBusConsumer, consumer_options
 
 
-def blacklist_binary(md5):
+class BlacklistWriter(object):
+    """
+    Blacklists md5 hashes from a background thread, over one pooled
+    connection to the Carbon Black Server.
+
+    The md5s already on the server's blacklist are fetched at startup, and
+    every md5 submitted since is remembered, so repeat watchlist hits on a
+    popular binary never reach the server.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.headers.update({'X-AUTH-TOKEN': cbtoken})
+        self.session.verify = False
+
+        # md5s that are blacklisted, or queued to be
+        self.banned = set()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+
+        self.load_blacklist()
+
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+
+    def load_blacklist(self):
+        """
+        Primes the set of banned md5s with the server's existing blacklist.
+        Bans that have been disabled don't count, so those md5s can be
+        banned again.
+        """
+        try:
+            r = self.session.get("https://%s/api/v1/banning/blacklist" % (cbserver))
+            r.raise_for_status()
+            for ban in r.json():
+                if ban.get('enabled'):
+                    self.banned.add(ban['md5hash'].lower())
+            print "%d md5 hashes are already blacklisted" % (len(self.banned))
+        except Exception, e:
+            print "Warning: could not retrieve the existing blacklist: %s" % (e)
+
+    def request(self, md5):
+        """
+        Queues the md5 to be blacklisted unless it already is.
+        Returns True if it was queued.
+        """
+        md5 = md5.lower()
+        with self.lock:
+            if md5 in self.banned:
+                return False
+            self.banned.add(md5)
+
+        self.queue.put(md5)
+        return True
+
+    def work(self):
+        while True:
+            md5 = self.queue.get()
+            try:
+                banned = blacklist_binary(self.session, md5)
+            except Exception, e:
+                print "Failed to blacklist md5:%s: %s" % (md5, e)
+                banned = False
+
+            if not banned:
+                # let the next hit on this md5 try again
+                with self.lock:
+                    self.banned.discard(md5)
+
+
+def blacklist_binary(session, md5):
     """
     Performs a POST to the Carbon Black Server API for blacklisting an MD5 hash
+    Returns True if the md5 hash is now blacklisted
     """
     print "blacklisting md5:%s" % (md5)
 
-    headers = {'X-AUTH-TOKEN': cbtoken}
-
     data = {"md5hash": md5,
             "text": "Auto-Blacklist From Watchlist",
             "last_ban_time": 0,
@@ -51,10 +122,8 @@ def blacklist_binary(md5):
             "last_ban_host": 0,
             "enabled": True}
 
-    r = requests.post("https://%s/api/v1/banning/blacklist" % (cbserver),
-                      headers=headers,
-                      data=json.dumps(data),
-                      verify=False)
+    r = session.post("https://%s/api/v1/banning/blacklist" % (cbserver),
+                     data=json.dumps(data))
 
     if r.status_code == 409:
         print "This md5 hash is already blacklisted"
@@ -63,50 +132,35 @@ def blacklist_binary(md5):
     else:
         print "CarbonBlack Server API returned an error: %d" % (r.status_code)
         print "Be sure to check the Carbon Black API token"
+        return False
+    return True
 
 
-def on_message(channel, method_frame, header_frame, body):
+def on_message(routing_key, content_type, body):
     """
     Callback function which filters out the feeds we care about.
+    The consumer acks every message once this returns.
     """
 
-    try:
-        if "application/json" == header_frame.content_type:
-
-            if method_frame.routing_key == 'watchlist.hit.binary':
-                print "watchlist.hit.binary consume"
+    if "application/json" == content_type:
 
-                parsed_json = json.loads(body)
-                if parsed_json['watchlist_id'] in watchlistsdict.values():
-                    lst = parsed_json['docs']
-                    for item in lst:
-                        blacklist_binary(item['md5'])
+        if routing_key == 'watchlist.hit.binary':
+            print "watchlist.hit.binary consume"
 
-            elif method_frame.routing_key == 'watchlist.hit.process':
-                print "watchlist.hit.process consume"
+            parsed_json = json.loads(body)
+            if parsed_json['watchlist_id'] in watchlistsdict.values():
+                lst = parsed_json['docs']
+                for item in lst:
+                    blacklister.request(item['md5'])
 
-                parsed_json = json.loads(body)
-                if parsed_json['watchlist_id'] in watchlistsdict.values():
-                    lst = parsed_json['docs']
-                    for item in lst:
-                        blacklist_binary(item['process_md5'])
+        elif routing_key == 'watchlist.hit.process':
+            print "watchlist.hit.process consume"
 
-    except Exception, e:
-        print e
-    finally:
-        # need to make sure we ack the messages so they don't get left un-acked
-        # in the queue we set multiple to true to ensure that we ack all
-        # previous messages
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag,
-                          multiple=True)
-    return
-
-
-def generate_queue_name():
-    """
-    generates a random queue name
-    """
-    return str(random.randint(0, 10000)) + "-" + str(random.randint(0, 100000))
+            parsed_json = json.loads(body)
+            if parsed_json['watchlist_id'] in watchlistsdict.values():
+                lst = parsed_json['docs']
+                for item in lst:
+                    blacklister.request(item['process_md5'])
 
 
 def parse_config_file(filename):
@@ -176,6 +230,7 @@ if __name__ == "__main__":
     global cbtoken
     global watchlistsdict
     global cbserver
+    global blacklister
 
     #
     # Parse the config file
@@ -201,43 +256,18 @@ if __name__ == "__main__":
     validate_watchlist_dict(watchlistsdict)
 
     #
-    # Set the connection parameters to connect to to the rabbitmq:5004
-    # using the supplied username and password
+    # md5s are blacklisted from a background thread, skipping the ones
+    # already on the server's blacklist, so messages are acked without
+    # waiting on the server
     #
-    credentials = pika.PlainCredentials(username,
-                                        password)
+    blacklister = BlacklistWriter()
 
     #
-    # Create our parameters for pika
+    # Consume from the Carbon Black Server's rabbitmq:5004 using the supplied
+    # username and password; see mbus_helpers for the optional settings
     #
-    parameters = pika.ConnectionParameters(cbserver,
-                                           5004,
-                                           '/',
-                                           credentials)
-
-    #
-    # Create the connection
-    #
-    connection = pika.BlockingConnection(parameters)
-
-    #
-    # Get the channel from the connection
-    #
-    channel = connection.channel()
-
-    #
-    # Create a random queue name
-    #
-    queue_name = generate_queue_name()
-
-    #
-    # make sure you use auto_delete so the queue isn't left filling
-    # with events when this program exists.
-    channel.queue_declare(queue=queue_name, auto_delete=True)
-
-    channel.queue_bind(exchange='api.events', queue=queue_name, routing_key='watchlist.hit.#')
-
-    channel.basic_consume(on_message, queue=queue_name)
+    consumer = MessageBusConsumer(cbserver, username, password, ['watchlist.hit.#'], on_message,
+                                  **consumer_options(configfile))
 
     print
     print "Subscribed to events!"
@@ -245,9 +275,4 @@ if __name__ == "__main__":
            "from watchlist.hit.process and watchlist.hit.binary hits!")
     print
 
-    try:
-        channel.start_consuming()
-    except KeyboardInterrupt:
-        channel.stop_consuming()
-
-    connection.close()
+    consumer.run()
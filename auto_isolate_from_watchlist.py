@@ -30,69 +30,104 @@
 #
 
 
-import pika
-import random
 import json
 import requests
 import sys
+import time
+import threading
+import Queue
 from ConfigParser import SafeConfigParser
+from mbus_helpers import MessageBusConsumer, consumer_options
 import cbapi
 
-def isolate_sensor(sensor):
-    global cbtoken
+
+class IsolationDispatcher(object):
+    """
+    Isolates sensors on a pool of worker threads that share one API client,
+    so that the message bus consumer never waits on the Carbon Black server.
+
+    Requests to isolate a sensor that has already been isolated (or is
+    queued to be) within the last window seconds are dropped, so a storm of
+    watchlist hits on one host makes a single API call.
+    """
+
+    def __init__(self, cb, workers=4, window=300):
+        self.cb = cb
+        self.window = window
+        self.queue = Queue.Queue()
+
+        # sensor id -> time of the last isolation request that was acted on
+        self.requested = {}
+        self.lock = threading.Lock()
+
+        for i in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def request(self, sensor):
+        """
+        Queue the sensor for isolation unless it was queued within the window.
+        Returns True if it was queued.
+        """
+        now = time.time()
+        with self.lock:
+            last = self.requested.get(sensor)
+            if last is not None and now - last < self.window:
+                return False
+            self.requested[sensor] = now
+
+        self.queue.put(sensor)
+        return True
+
+    def work(self):
+        while True:
+            sensor = self.queue.get()
+            try:
+                isolate_sensor(self.cb, sensor)
+            except Exception, e:
+                print "Failed to isolate sensor %s: %s" % (sensor, e)
+
+                # let the next hit on this sensor try again
+                with self.lock:
+                    self.requested.pop(sensor, None)
+
+
+def isolate_sensor(cb, sensor):
     global cbserver
 
     print "Isolating sensor %s on %s..." % (sensor, cbserver)
 
-    cbURL = "https://" + cbserver
-    cb = cbapi.CbApi(cbURL, token=cbtoken, ssl_verify=False)
     status = cb.sensor_toggle_isolation(sensor,True)
 
     print "status was %s" % status
 
-def on_message(channel, method_frame, header_frame, body):
+def on_message(routing_key, content_type, body):
     """
     Callback function which filters out the feeds we care about.
+    The consumer acks every message once this returns.
     """
 
-    try:
-        if "application/json" == header_frame.content_type:
+    if "application/json" == content_type:
 
-            if method_frame.routing_key == 'watchlist.hit.binary':
-                print "watchlist.hit.binary consume"
+        if routing_key == 'watchlist.hit.binary':
+            print "watchlist.hit.binary consume"
 
-                parsed_json = json.loads(body)
-                if parsed_json['watchlist_id'] in watchlistsdict.values():
-                    lst = parsed_json['docs']
-                    for item in lst:
-                        isolate_sensor(parsed_json['docs'][0]['sensor_id'])
+            parsed_json = json.loads(body)
+            if parsed_json['watchlist_id'] in watchlistsdict.values():
+                # each sensor is isolated once, however many of its
+                # documents hit
+                for sensor in set(item['sensor_id'] for item in parsed_json['docs']):
+                    dispatcher.request(sensor)
 
-            elif method_frame.routing_key == 'watchlist.hit.process':
-                print "watchlist.hit.process consume"
+        elif routing_key == 'watchlist.hit.process':
+            print "watchlist.hit.process consume"
 
-                parsed_json = json.loads(body)
-                #print parsed_json['docs'][0]['sensor_id']
-                if parsed_json['watchlist_id'] in watchlistsdict.values():
-                    lst = parsed_json['docs']
-                    for item in lst:
-                        isolate_sensor(parsed_json['docs'][0]['sensor_id'])
-
-    except Exception, e:
-        print e
-    finally:
-        # need to make sure we ack the messages so they don't get left un-acked
-        # in the queue we set multiple to true to ensure that we ack all
-        # previous messages
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag,
-                          multiple=True)
-    return
-
-
-def generate_queue_name():
-    """
-    generates a random queue name
-    """
-    return str(random.randint(0, 10000)) + "-" + str(random.randint(0, 100000))
+            parsed_json = json.loads(body)
+            #print parsed_json['docs'][0]['sensor_id']
+            if parsed_json['watchlist_id'] in watchlistsdict.values():
+                for sensor in set(item['sensor_id'] for item in parsed_json['docs']):
+                    dispatcher.request(sensor)
 
 
 def parse_config_file(filename):
@@ -108,7 +143,19 @@ def parse_config_file(filename):
             unicode(parser.get("settings", "rabbitmqpassword"), "utf-8"),
             unicode(parser.get("settings", "cbserverip"), "utf-8"),
             unicode(parser.get("settings", "cbtoken"), "utf-8"),
-            unicode(parser.get("settings", "watchlists"), "utf-8"))
+            unicode(parser.get("settings", "watchlists"), "utf-8"),
+            get_int_setting(parser, "isolationworkers", 4),
+            get_int_setting(parser, "isolationwindow", 300))
+
+
+def get_int_setting(parser, option, default):
+    """
+    Returns an optional integer setting, or the default if it isn't set
+    """
+
+    if parser.has_option("settings", option):
+        return parser.getint("settings", option)
+    return default
 
 
 def validate_watchlist_dict(watchlistsdict):
@@ -162,11 +209,12 @@ if __name__ == "__main__":
     global cbtoken
     global watchlistsdict
     global cbserver
+    global dispatcher
 
     #
     # Parse the config file
     #
-    (username, password, cbserver, cbtoken, watchlists) = parse_config_file(configfile)
+    (username, password, cbserver, cbtoken, watchlists, workers, window) = parse_config_file(configfile)
 
     #
     # Build a dictionary of "WatchList Name" -> "Watchlist ID"
@@ -187,43 +235,18 @@ if __name__ == "__main__":
     validate_watchlist_dict(watchlistsdict)
 
     #
-    # Set the connection parameters to connect to to the rabbitmq:5004
-    # using the supplied username and password
-    #
-    credentials = pika.PlainCredentials(username,
-                                        password)
-
-    #
-    # Create our parameters for pika
+    # Isolation requests are handed to a pool of workers sharing a single
+    # API client, so messages are acked without waiting on the server
     #
-    parameters = pika.ConnectionParameters(cbserver,
-                                           5004,
-                                           '/',
-                                           credentials)
+    dispatcher = IsolationDispatcher(cbapi.CbApi("https://" + cbserver, token=cbtoken, ssl_verify=False),
+                                     workers=workers, window=window)
 
     #
-    # Create the connection
+    # Consume from the Carbon Black Server's rabbitmq:5004 using the supplied
+    # username and password; see mbus_helpers for the optional settings
     #
-    connection = pika.BlockingConnection(parameters)
-
-    #
-    # Get the channel from the connection
-    #
-    channel = connection.channel()
-
-    #
-    # Create a random queue name
-    #
-    queue_name = generate_queue_name()
-
-    #
-    # make sure you use auto_delete so the queue isn't left filling
-    # with events when this program exists.
-    channel.queue_declare(queue=queue_name, auto_delete=True)
-
-    channel.queue_bind(exchange='api.events', queue=queue_name, routing_key='watchlist.hit.#')
-
-    channel.basic_consume(on_message, queue=queue_name)
+    consumer = MessageBusConsumer(cbserver, username, password, ['watchlist.hit.#'], on_message,
+                                  **consumer_options(configfile))
 
     print
     print "Subscribed to events!"
@@ -231,9 +254,4 @@ if __name__ == "__main__":
            "from watchlist.hit.process and watchlist.hit.binary hits!")
     print
 
-    try:
-        channel.start_consuming()
-    except KeyboardInterrupt:
-        channel.stop_consuming()
-
-    connection.close()
+    consumer.run()
@@ -35,6 +35,8 @@ import sys
 import optparse
 import cbapi 
 
+from checkpoint_helpers import Checkpoint
+
 def build_cli_parser():
     parser = optparse.OptionParser(usage="%prog [options]", description="Dump All MD5s from the binary index")
 
@@ -50,6 +52,12 @@ def build_cli_parser():
                       help="Number of MD5s to retrieve during each API invocation")
     parser.add_option("-f", "--file", action="store", default=None, dest="filename",
                       help="filename of file to write all md5s to")
+    parser.add_option("-k", "--checkpoint", action="store", default=None, dest="checkpoint",
+                      help="File to periodically save progress to, so that an interrupted run can be resumed")
+    parser.add_option("--checkpoint-interval", action="store", default=60, dest="checkpoint_interval", type="int",
+                      help="Minimum number of seconds between checkpoints (default 60)")
+    parser.add_option("-R", "--resume", action="store_true", default=False, dest="resume",
+                      help="Resume from the last checkpoint saved to the --checkpoint file")
     return parser
 
 def main(argv):
@@ -58,6 +66,9 @@ def main(argv):
     if not opts.url or not opts.token or not opts.pagesize or not opts.filename:
         print "Missing required param; run with --help for usage"
         sys.exit(-1)
+    if opts.resume and not opts.checkpoint:
+        print "--resume requires a --checkpoint file"
+        sys.exit(-1)
 
     # build a cbapi object
     #
@@ -67,6 +78,21 @@ def main(argv):
     md5s = []
     total = 0
 
+    # periodically save the start row and the md5s retrieved so far, so
+    # that an interrupted run can pick up where it left off
+    #
+    checkpoint = None
+    if opts.checkpoint:
+        checkpoint = Checkpoint(opts.checkpoint, opts.checkpoint_interval)
+
+    if opts.resume:
+        state = checkpoint.load()
+        if state is not None:
+            start = state['start']
+            md5s = state['md5s']
+            total = state['total']
+            print "Resuming from row %d of %d" % (start, total)
+
     while True:
    
         # perform a single binary search
@@ -90,10 +116,18 @@ def main(argv):
 
         start = start + int(opts.pagesize)
 
+        if checkpoint:
+            checkpoint.save({'start': start, 'md5s': md5s, 'total': total})
+
     f = open(opts.filename, 'w')
     for md5 in md5s:
         f.write("%s\n" % (md5,))
     f.close()
 
+    # the export is complete; there is nothing left to resume
+    #
+    if checkpoint:
+        checkpoint.remove()
+
 if __name__ == "__main__":
     sys.exit(main(sys.argv[1:]))
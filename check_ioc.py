@@ -32,11 +32,11 @@
 
 
 import sys
-import struct
-import socket
 from optparse import OptionParser
 from cbapi import CbApi
 
+import netconn_helpers
+
 # if you run this in a cron job, 
 # put the interval here.  This uses the format
 # In the last xxx minutes format.  The parser accepts
@@ -71,21 +71,16 @@ class CBQuery(object):
         events = self.cb.process_events(result["id"], result["segment_id"])
         proc = events["process"]
 
-        if type == "domain" and proc.has_key("netconn_complete"):
-            for netconn in proc["netconn_complete"]:
-                ts, ip, port, proto, domain, dir = netconn.split("|")
-                if ioc in domain:
-                    str_ip = socket.inet_ntoa(struct.pack("!i", int(ip)))
-                    print "%s\t%s (%s:%s)" % (ts, domain, str_ip, port)
-
-        elif type == "ipaddr" and proc.has_key("netconn_complete"):
-            for netconn in proc["netconn_complete"]:
-                ts, ip, port, proto, domain, direction = netconn.split("|")
-                packed_ip = struct.unpack("!i", socket.inet_aton(ioc))[0]
-                #import code; code.interact(local=locals())
-                if packed_ip == int(ip):
-                    str_ip = socket.inet_ntoa(struct.pack("!i", int(ip)))
-                    print "%s\t%s (%s:%s)" % (ts, domain, str_ip, port)
+        if type in ("domain", "ipaddr") and proc.has_key("netconn_complete"):
+            netconns, domains = netconn_helpers.decode_netconns(proc["netconn_complete"])
+            if type == "domain":
+                mask = netconn_helpers.domain_mask(netconns, domains, ioc)
+            else:
+                mask = netconn_helpers.ip_mask(netconns, ioc)
+
+            for netconn in netconns[mask]:
+                str_ip = netconn_helpers.int_to_ip(netconn["ip"])
+                print "%s\t%s (%s:%s)" % (netconn["timestamp"], domains[netconn["domain_id"]], str_ip, netconn["port"])
 
         elif type == "md5" and proc.has_key("modload_complete"):
             for modload in proc["modload_complete"]:
@@ -96,38 +91,78 @@ class CBQuery(object):
             if result["process_md5"] == ioc:
                 print "%s\t%s %s" % (result["start"], result["process_md5"], result["path"])
 
-    def check(self, iocs, type, detail=False):
+    def build_query(self, iocs, type):
+        # OR together a search term for each ioc, e.g.
+        #   (md5:ce7a81ceccfa03e5e0dfd0d9a7f41466 OR md5:001dd76872d80801692ff942308c64e6)
+        #
+        # additionally, if a cron interval is specified, limit searches
+        # to processes updated in the last CRON_INTERVAL period
+        #
+        q = " OR ".join(["%s:%s" % (type, ioc) for ioc in iocs])
+        if len(iocs) > 1:
+            q = "(%s)" % (q,)
+        if CRON_INTERVAL:
+            q = "%s and last_update:-%s" % (q, CRON_INTERVAL)
+        return q
+
+    def check_one(self, ioc, type, detail=False):
+        q = self.build_query([ioc], type)
+        print q
+        procs = self.cb.process_search(q)
+
+        # if there are _any_ hits, give us the details.
+        # then check the next ioc
+        if len(procs["results"]) > 0:
+            self.report(ioc, type, procs, detail)
+        else:
+            sys.stdout.write(".")
+            sys.stdout.flush()
+
+    def check_batch(self, iocs, type, detail=False):
+        # a single ioc is searched (and reported) exactly as in the
+        # unbatched case
+        if len(iocs) == 1:
+            self.check_one(iocs[0], type, detail)
+            return
+
+        # only ask for the hit count; rows=0 keeps the response small
+        procs = self.cb.process_search(self.build_query(iocs, type), rows=0)
+
+        # the common case - no ioc in this batch matched anything
+        if procs["total_results"] == 0:
+            sys.stdout.write("." * len(iocs))
+            sys.stdout.flush()
+            return
+
+        # at least one ioc in this batch matched; split the batch in half
+        # and check each half in turn until we are down to the individual
+        # iocs that are responsible for the hits
+        middle = len(iocs) / 2
+        self.check_batch(iocs[:middle], type, detail)
+        self.check_batch(iocs[middle:], type, detail)
+
+    def check(self, iocs, type, detail=False, batch_size=1):
         # for each ioc, do a search for (type):(ioc)
         # e.g, 
         #   domain:bigfish.com
         #   md5:ce7a81ceccfa03e5e0dfd0d9a7f41466
         # 
-        # additionally, if a cron interval is specified, limit searches
-        # to processes updated in the last CRON_INTERVAL period
-        # 
-        # note - this is a very inefficient way to do this, since you test only one
-        # IOC per request - you could build a large OR clause together with a few hundred
-        # to efficiently and quickly check 1000s of IOCs, at the cost of increased complexity
-        # when you discover a hit.
+        # testing only one IOC per request is a very inefficient way to do
+        # this.  with a batch size greater than one, a large OR clause is
+        # built from up to batch_size IOCs, and the hit count for the whole
+        # clause is checked in a single request.  only when a batch has
+        # hits is it bisected to discover which IOCs matched.
         #
-        # note 2 - with a list of flat indicators, what you really want is a CB feed
+        # note - with a list of flat indicators, what you really want is a CB feed
         # see http://github.com/carbonblack/cbfeeds
         #
-        for ioc in iocs:
-            if CRON_INTERVAL:
-                q = "%s:%s and last_update:-%s" % (type, ioc, CRON_INTERVAL)
-            else:
-                q = "%s:%s" % (type, ioc)
-            print q
-            procs = self.cb.process_search(q)
-
-            # if there are _any_ hits, give us the details.
-            # then check the next ioc
-            if len(procs["results"]) > 0:
-                self.report(ioc, type, procs, detail)
-            else:
-                sys.stdout.write(".")
-                sys.stdout.flush()
+        if batch_size <= 1:
+            for ioc in iocs:
+                self.check_one(ioc, type, detail)
+            return
+
+        for i in xrange(0, len(iocs), batch_size):
+            self.check_batch(iocs[i:i + batch_size], type, detail)
 
 def build_cli_parser():
     parser = OptionParser(usage="%prog [options]", description="check Cb index for provided IOCs")
@@ -143,6 +178,10 @@ def build_cli_parser():
                       help="Type of IOCs in the file.  Must be one of md5, domain or ipaddr")
     parser.add_option("-d", "--detail", action="store_true", default=False, dest="detail",
                       help="Get full detail about each IOC hit.")
+    parser.add_option("-b", "--batch-size", action="store", default=1, dest="batch_size", type="int",
+                      help="Number of IOCs to OR together in a single query; batches with hits are " +
+                           "split in half until the matching IOCs are found.  Default is 1; a few " +
+                           "hundred is a good choice for large IOC lists")
     parser.add_option("-n", "--no-ssl-verify", action="store_false", default=True, dest="ssl_verify",
                       help="Do not verify server SSL certificate.")
     return parser
@@ -164,9 +203,10 @@ def main(argv):
     # get the IOCs to check; this is a list of strings, one indicator
     # per line.  strip off the newlines as they come in
     vals = [val.strip() for val in open(opts.fname, "r")]
+    vals = [val for val in vals if val]
 
     # check each!
-    cb.check(vals, opts.type, opts.detail)
+    cb.check(vals, opts.type, opts.detail, opts.batch_size)
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv[1:]))
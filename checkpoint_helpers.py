@@ -0,0 +1,98 @@
+#
+#The MIT License (MIT)
+#
+# Copyright (c) 2016 Carbon Black
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# -----------------------------------------------------------------------------
+#  Shared checkpoint helpers
+#
+#  Scripts that page through the entire datastore can run for hours, and a
+#  transient HTTP error or a Ctrl-C would otherwise throw away all progress.
+#  A Checkpoint periodically writes the paging cursor together with the
+#  partial results of such a scan to a compressed file, so that the scan can
+#  be resumed from the last checkpoint rather than from the beginning.
+#
+#  The state is saved only at points where the cursor and the partial results
+#  agree, so a resumed scan neither misses nor double counts a page.  Results
+#  are paged by offset, so processes or binaries added to the server between
+#  runs may shift the pages.
+#
+
+import os
+import gzip
+import time
+import cPickle
+
+
+class Checkpoint(object):
+    """
+    Saves the state of a long-running scan to a file at most once every
+    interval seconds, and loads it back when the scan is resumed.
+    """
+    def __init__(self, filename, interval=60):
+        self.filename = filename
+        self.interval = interval
+        self.last_save = time.time()
+
+    def load(self):
+        """
+        return the saved state, or None if there is no checkpoint file
+        """
+        if not os.path.exists(self.filename):
+            return None
+
+        f = gzip.open(self.filename, "rb")
+        try:
+            return cPickle.load(f)
+        finally:
+            f.close()
+
+    def save(self, state, force=False):
+        """
+        save the state if the interval has passed since the last save (or if
+        forced); the previous checkpoint is only replaced once the new one
+        has been written out in full.  returns True if the state was saved
+        """
+        now = time.time()
+        if not force and now - self.last_save < self.interval:
+            return False
+
+        tmp_filename = self.filename + ".tmp"
+        f = gzip.open(tmp_filename, "wb")
+        try:
+            cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+        # rename will not replace an existing file on windows
+        if os.name == "nt" and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp_filename, self.filename)
+
+        self.last_save = now
+        return True
+
+    def remove(self):
+        """
+        remove the checkpoint file once the scan has completed
+        """
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,126 @@
+#
+#The MIT License (MIT)
+#
+# Copyright (c) 2016 Carbon Black
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# -----------------------------------------------------------------------------
+#  Shared counting helpers
+#
+#  Counting every distinct string seen across a large fleet (command lines,
+#  usernames) needs one dictionary entry per distinct string, which can take
+#  several GB.  SpaceSavingCounter bounds that to a fixed number of entries
+#  using the Space-Saving algorithm (Metwally, Agrawal & El Abbadi, 2005):
+#  the most frequent strings are always kept, and every count is an upper
+#  bound that overstates the true count by at most the entry's error.
+#
+
+import heapq
+
+
+class SpaceSavingCounter(object):
+    """
+    Counts occurrences of keys in at most capacity entries.  When full, a
+    new key replaces the key with the lowest count and inherits that count
+    as its error.  With a capacity of None, every key is kept and every
+    count is exact.
+    """
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+        # min-heap of (count, key); entries whose count is out of date are
+        # skipped when popped, and dropped whenever the heap is rebuilt
+        self.heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def add(self, key, count=1):
+        """
+        count one (or count) more occurrence of key; returns True if the key
+        was not already being counted
+        """
+        if key in self.counts:
+            self.counts[key] = self.counts[key] + count
+            if self.capacity is not None:
+                self._push(self.counts[key], key)
+            return False
+
+        if self.capacity is None or len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            min_count, min_key = self._pop_min()
+            del self.counts[min_key]
+            del self.errors[min_key]
+            self.counts[key] = min_count + count
+            self.errors[key] = min_count
+
+        if self.capacity is not None:
+            self._push(self.counts[key], key)
+        return True
+
+    def error(self, key):
+        """
+        return the most the count of key can overstate its true count by
+        """
+        return self.errors[key]
+
+    def max_error(self):
+        if not self.errors:
+            return 0
+        return max(self.errors.itervalues())
+
+    def items(self):
+        """
+        return the (key, count) pairs of every counted key
+        """
+        return self.counts.items()
+
+    def top(self, k):
+        """
+        return the (key, count, guaranteed) tuples of the k highest counts,
+        highest first.  guaranteed is True if the key is certain to be
+        among the true top k, i.e. its lowest possible count is at least
+        the count of the first key left out
+        """
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        if len(ranked) > k:
+            threshold = ranked[k][1]
+        else:
+            threshold = 0
+        return [(key, count, count - self.errors[key] >= threshold) for key, count in ranked[:k]]
+
+    def _push(self, count, key):
+        heapq.heappush(self.heap, (count, key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, key) for key, count in self.counts.iteritems()]
+            heapq.heapify(self.heap)
+
+    def _pop_min(self):
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                return count, key
@@ -1,23 +1,24 @@
 try:
     from cbapi.legacy.util.cli_helpers import main_helper
-    from cbapi.legacy.util.live_response_helpers import LiveResponseHelper
 except ImportError:
     from cbapi.util.cli_helpers import main_helper
-    from cbapi.util.live_response_helpers import LiveResponseHelper
+
+import lr_fleet_helpers
 
 def main(cb, args):
     filepath = args.get('filepath')
-    sensor_id = int(args.get('sensorid'))
-    lrh = LiveResponseHelper(cb, sensor_id)
-    lrh.start()
+
+    def del_file(lrh, sensor):
+        return lrh.del_file(filepath)
+
+    def report(sensor, results):
+        print "[+] %s: %s" % (lr_fleet_helpers.describe(sensor),
+                              ", ".join(i + ' = ' + str(results[i]) for i in results))
+
     print "[*] Attempting to delete file: %s" % filepath
-    results = lrh.del_file(filepath)
-    print "\n[+] Results:\n============"
-    for i in results:
-        print i + ' = ' + str(results[i])
-    lrh.stop()
+    lr_fleet_helpers.run_on_sensors(cb, args, del_file, report)
 
 if __name__ == "__main__":
-    sensor_arg = ("-s", "--sensorid", "store", None, "sensorid", "Sensor id")
     file_arg = ("-f", "--filepath", "store", None, "filepath", "File Path")
-    main_helper("Remove file from remote sensor", main, custom_required=[sensor_arg, file_arg])
+    main_helper("Remove file from remote sensors", main, custom_required=[file_arg],
+                custom_optional=lr_fleet_helpers.FLEET_OPTIONS)
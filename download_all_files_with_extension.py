@@ -38,9 +38,15 @@
 #
 #  last updated 2015-05-25 by Ben Johnson bjohnson@bit9.com
 #
+import os
 import sys
 import time
+import hashlib
+import tempfile
 import traceback
+import Queue
+from threading import Thread, Lock
+import requests
 try:
     from cbapi.legacy.util.cli_helpers import main_helper
     from cbapi.legacy.util.composite_helpers import MessageSubscriberAndLiveResponseActor
@@ -50,16 +56,29 @@ except ImportError:
     from cbapi.util.composite_helpers import MessageSubscriberAndLiveResponseActor
     import cbapi.util.sensor_events_pb2 as cpb
 
+import protobuf_helpers
+
+# files are fetched and written this many bytes at a time
+CHUNK_SIZE = 1024 * 1024
+
 class ExtensionFileWatcherAndGrabber(MessageSubscriberAndLiveResponseActor):
     """
     This class subscribes to messages from the CB messaging bus,
     looking for filemod events.  For each filemod event, it checks
-    to see if the file ends in .dmp.  If it does, it goes and
-    grabs it.
+    to see if the file ends in one of the extensions (e.g. .dmp).
+    If it does, it goes and grabs it.
+
+    Files are grabbed by a pool of worker threads, so a large file does
+    not hold up the messages behind it, and streamed to disk a chunk at a
+    time.  Each file is stored once under its SHA-256, however many hosts
+    it came from; index.csv in the output directory records every grab.
     """
-    def __init__(self, cb_server_url, cb_ext_api, username, password, extensions, output_dir):
+    def __init__(self, cb_server_url, cb_ext_api, username, password, extensions, output_dir, workers=4,
+                 queue_size=100, session_timeout=120):
         self.output_dir = output_dir
-        self.extensions = extensions
+        self.session_timeout = session_timeout
+        # str.endswith checks every suffix in one call
+        self.extensions = tuple(set(extensions))
         MessageSubscriberAndLiveResponseActor.__init__(self,
                                                        cb_server_url,
                                                        cb_ext_api,
@@ -67,21 +86,39 @@ class ExtensionFileWatcherAndGrabber(MessageSubscriberAndLiveResponseActor):
                                                        password,
                                                        "ingress.event.filemod")
 
-    def __generate_filename(self, sensor_id, filemod_path):
-        """
-        Returns a path that is the concatenation of the output directory and
-        the filename, with some effort done to replace characters that might be
-        tricky in linux/OSX.
-        """
-        filename = "%d-%s" % (sensor_id, filemod_path)
-        filename = filename.replace(":", "_").replace("\\", "__").replace(" ", "_")
-        return filename
+        # (sensor id, path) of the files queued or being grabbed; a file that
+        # is still being written triggers many modification events
+        self.lock = Lock()
+        self.pending = set()
+        self.queue = Queue.Queue(queue_size)
+
+        # a live response session runs one command at a time, so the workers
+        # take turns on each sensor
+        self.sensor_locks = {}
+
+        self.go = True
+        self.worker_threads = []
+        for i in range(workers):
+            worker_thread = Thread(target=self._worker_thread_loop)
+            worker_thread.start()
+            self.worker_threads.append(worker_thread)
+
+    def on_stop(self):
+        self.go = False
+        for worker_thread in self.worker_threads:
+            worker_thread.join(timeout=2)
+        MessageSubscriberAndLiveResponseActor.on_stop(self)
 
     def consume_message(self, channel, method_frame, header_frame, body):
         if "application/protobuf" != header_frame.content_type:
             return
 
         try:
+            # Most messages aren't modifications, so check that from the raw
+            # message before paying for a full parse
+            if not protobuf_helpers.may_have_mod_action(body, protobuf_helpers.CBEVENTMSG_FILEMOD, 2):
+                return
+
             # NOTE -- this is not very efficient in PYTHON, and should
             # use a C parser to make this much, much faster.
             # http://yz.mit.edu/wp/fast-native-c-protocol-buffers-from-python/
@@ -99,49 +136,117 @@ class ExtensionFileWatcherAndGrabber(MessageSubscriberAndLiveResponseActor):
             # A little non-ideal but this is how the protobuf is setup
             for s in x.strings:
                 if s.string_type == 1: #File Path String
-                    for extension in self.extensions:
-                        if s.utf8string.endswith(extension):
-                            filemod_path = s.utf8string
-                            break
+                    if s.utf8string.endswith(self.extensions):
+                        filemod_path = s.utf8string
 
             if filemod_path:
                 # Go Grab it if we think we have something!
-
                 sensor_id = x.env.endpoint.SensorId
                 hostname = x.env.endpoint.SensorHostName
 
-                # Establish our CBLR session if necessary!
-                lrh = self._create_lr_session_if_necessary(sensor_id)
-
-                # Grab the data!  # TODO -- what if this is LARGE??
-                data = lrh.get_file(filemod_path)
-
-                # Generate a filepath and write it out!
-                output_filepath = "%s/%s" % (self.output_dir,
-                                             self.__generate_filename(sensor_id, filemod_path))
-                fout = open(output_filepath, 'wb')
-                fout.write(data)
-                fout.close()
-
-                print "%s Received %s(%d) %s (%d bytes) => %s" % (time.asctime(),
-                                                                  hostname,
-                                                                  sensor_id,
-                                                                  filemod_path,
-                                                                  len(data),
-                                                                  output_filepath)
+                with self.lock:
+                    if (sensor_id, filemod_path) in self.pending:
+                        return
+                    self.pending.add((sensor_id, filemod_path))
+
+                try:
+                    self.queue.put_nowait((sensor_id, hostname, filemod_path))
+                except Queue.Full:
+                    print "%s Dropping %s(%d) %s, too many files queued" % (time.asctime(), hostname, sensor_id,
+                                                                           filemod_path)
+                    with self.lock:
+                        self.pending.discard((sensor_id, filemod_path))
         except:
             traceback.print_exc()
 
+    def _worker_thread_loop(self):
+        while self.go:
+            try:
+                (sensor_id, hostname, filemod_path) = self.queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+
+            try:
+                self._grab_file(sensor_id, hostname, filemod_path)
+            except:
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.pending.discard((sensor_id, filemod_path))
+
+    def _grab_file(self, sensor_id, hostname, filemod_path):
+        # Establish our CBLR session if necessary!
+        with self.lock:
+            lrh = self._create_lr_session_if_necessary(sensor_id)
+            sensor_lock = self.sensor_locks.setdefault(sensor_id, Lock())
+
+        # don't hold up the worker on a sensor that is offline; the session
+        # keeps trying in the background for the sensor's next file
+        if not lrh.ready_event.wait(self.session_timeout):
+            print "%s Live response session for %s(%d) not ready, dropping %s" % (time.asctime(), hostname,
+                                                                                  sensor_id, filemod_path)
+            return
+
+        # Have the sensor upload the file to the server, then stream it from there
+        with sensor_lock:
+            command = self.cb.live_response_session_command_post(lrh.session_id, "get file", filemod_path)
+            result = self.cb.live_response_session_command_get(lrh.session_id, command.get('id'), wait=True)
+        url = "%s/api/v1/cblr/session/%d/file/%d/content" % (self.cb.server, lrh.session_id, result["file_id"])
+        if hasattr(self.cb, "cbapi_get"):
+            r = self.cb.cbapi_get(url, timeout=120, stream=True)
+        else:
+            r = requests.get(url, headers=self.cb.token_header, verify=self.cb.ssl_verify, timeout=120, stream=True)
+        r.raise_for_status()
+
+        # Write it out under a temporary name, hashing as we go
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, temp_filepath = tempfile.mkstemp(dir=self.output_dir, prefix=".partial-")
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    fout.write(chunk)
+
+            # then keep it under its hash, unless we already have it
+            output_filepath = os.path.join(self.output_dir, sha256.hexdigest())
+            if os.path.exists(output_filepath):
+                os.remove(temp_filepath)
+            else:
+                os.rename(temp_filepath, output_filepath)
+        except:
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+            raise
+        finally:
+            r.close()
+
+        with self.lock:
+            with open(os.path.join(self.output_dir, "index.csv"), 'a') as index:
+                index.write("%s,%s,%d,%s,%d,%s\n" % (time.asctime(), hostname, sensor_id, filemod_path, size,
+                                                   sha256.hexdigest()))
+
+        print "%s Received %s(%d) %s (%d bytes) => %s" % (time.asctime(),
+                                                          hostname,
+                                                          sensor_id,
+                                                          filemod_path,
+                                                          size,
+                                                          output_filepath)
+
 
 def main(cb, args):
 
     username = args.get("username")
     password = args.get("password")
     output = args.get("output")
-    extensions = args.get("extensions").split(",")
+    extensions = [extension.strip() for extension in args.get("extensions").split(",") if extension.strip()]
 
 
-    listener = ExtensionFileWatcherAndGrabber(args.get('server_url'), cb, username, password, extensions, output)
+    listener = ExtensionFileWatcherAndGrabber(args.get('server_url'), cb, username, password, extensions, output,
+                                              workers=int(args.get("workers")),
+                                              queue_size=int(args.get("queue_size")),
+                                              session_timeout=int(args.get("session_timeout")))
 
     try:
         print "Extension File Watcher and Grabber -- started.  Watching for:", extensions
@@ -156,7 +261,13 @@ if __name__ == "__main__":
                     ("-p", "--password", "store", None, "password", "CB messaging password"),
                     ("-e", "--extensions", "store", None, "extensions", "Extensions to watch for (e.g .dmp, .vbs), comma-delimited"),
                     ("-o", "--output", "store", None, "output", "Output directory for captured files")]
+    optional_args = [("-w", "--workers", "store", 4, "workers", "Number of files to grab at once"),
+                     ("-q", "--queue-size", "store", 100, "queue_size",
+                      "Most files waiting to be grabbed; more are dropped"),
+                     ("-t", "--session-timeout", "store", 120, "session_timeout",
+                      "Seconds to wait for a sensor's live response session before dropping the file")]
 
     main_helper("Subscribe to message bus events and for each file with specified extension, go retrieve it.",
                 main,
-                custom_required=required_args)
+                custom_required=required_args,
+                custom_optional=optional_args)
@@ -7,9 +7,47 @@ import sys
 import threading
 import time
 import os
+import queue
+import gzip
+import shutil
+import sqlite3
+from datetime import datetime, timezone
 
 API_TIMEOUT_DEFAULT = 15
 
+EVENT_ROWS_PER_PAGE = 5000
+
+# the first poll (with no watermark yet) looks back over this window
+INITIAL_SEARCH_WINDOW = '3h'
+
+# the time between polls grows while polls find no new events, and shrinks
+# while they do
+POLL_INTERVAL_MIN = 5
+POLL_INTERVAL_MAX = 60
+
+# the most batches of events the collectors may queue ahead of the writer
+EVENT_QUEUE_SIZE = 64
+
+# (csv column, path of keys to the value in an event, value when missing)
+EXPORT_FIELDS = [
+    ('eventId', ('eventId',), ''),
+    ('sourceAddress', ('netFlow', 'sourceAddress'), ''),
+    ('destAddress', ('netFlow', 'destAddress'), ''),
+    ('threatIndicators', ('threatIndicators',), []),
+    ('deviceName', ('deviceDetails', 'deviceName'), ''),
+    ('parentName', ('processDetails', 'parentName'), ''),
+    ('name', ('processDetails', 'name'), ''),
+    ('appName', ('selectedApp', 'applicationName'), ''),
+    ('targetAppName', ('targetApp', 'applicationName'), ''),
+    ('parentAppName', ('parentApp', 'applicationName'), ''),
+]
+
+CSV_BUFFER_SIZE = 1024 * 1024
+CSV_ROWS_PER_WRITE = 10000
+
+# the least time between deleting old events and merging finished segments
+COMPACTION_INTERVAL = 60 * 60
+
 
 #
 # Prerequisites:
@@ -28,9 +66,24 @@ API_TIMEOUT_DEFAULT = 15
 # Description:
 # Script will run for a specified number of minutes specified by --minutes. Default is 1 minute.
 # After the script runs it will output a csv file by default named event_export.csv.  History on events is kept
-# between runs in files event_ids.json and events.json.  Keep these files so we don't export duplicates.
+# between runs in event_ids.db and the events directory.  Keep these so we don't export duplicates.
 #
-# Note: Eventually event_ids.json and events.json will get too large.  Delete them once the script start lagging behind.
+# event_ids.db is an indexed sqlite database of the event ids seen so far, so checking for duplicates stays fast
+# however long the script has been running.  An event_ids.json file left by an older version of this script is
+# imported into it on the first run.
+#
+# Each poll only asks for the events since the previous poll (going back --watermark-overlap seconds further for
+# events the server indexes late), and polls less often while there are no new events.  The time of the last poll
+# is kept in event_ids.db, so a new run picks up where the last one left off.
+#
+# --event-types takes a comma separated list of event types (NETWORK, FILE, REGISTRY, PROCESS, ...).  Each type
+# is polled by its own collector thread, from its own watermark, and a single writer thread appends the events of
+# every type to the event store.
+#
+# The event store (the events directory) keeps the events in gzip-compressed segment files, one for each
+# --segment-minutes of event time, listed in manifest.json.  Segments, and the event ids in event_ids.db, older than
+# --retention-days are deleted automatically, so neither grows without bound.  An events.json file left by an
+# older version of this script is moved into the store on the first run.
 #
 # Example Run:
 # $ python3 event_export.py --defense-api-url=https://api-prod05.conferdeploy.net --connector-id=<connector_id> --api-key=<api_key> --minutes=1
@@ -41,60 +94,353 @@ API_TIMEOUT_DEFAULT = 15
 # [+] Done
 #
 
-class EventThread(threading.Thread):
-    def __init__(self, args):
-        super().__init__()
+class EventIdIndex(object):
+    """
+    Persistent set of the event ids already exported, kept in an indexed
+    sqlite table so that membership tests don't slow down as it grows.
+    A connection may only be used by the thread that opened it.
+    """
+    def __init__(self, filename='event_ids.db', legacy_filename='event_ids.json'):
+        new = not os.path.exists(filename)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS event_ids (event_id TEXT PRIMARY KEY, time_ms INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS watermarks (event_type TEXT PRIMARY KEY, time_ms INTEGER)')
+
+        # ids recorded before event times were kept start aging out from now
+        now = int(time.time() * 1000)
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(event_ids)')]
+        if 'time_ms' not in columns:
+            self.connection.execute('ALTER TABLE event_ids ADD COLUMN time_ms INTEGER')
+            self.connection.execute('UPDATE event_ids SET time_ms = ?', (now,))
+        self.connection.execute('CREATE INDEX IF NOT EXISTS event_ids_time ON event_ids (time_ms)')
+
+        # carry over the history kept by older versions of this script
+        if new and os.path.exists(legacy_filename):
+            with open(legacy_filename, 'r') as fp:
+                self.connection.executemany('INSERT OR IGNORE INTO event_ids VALUES (?, ?)',
+                                            ((line.strip(), now) for line in fp if line.strip()))
+        self.connection.commit()
+
+    def add(self, event_id, time_ms):
+        """
+        Record the event id, and the event's time; returns True if it had not
+        been seen before.
+        """
+        cursor = self.connection.execute('INSERT OR IGNORE INTO event_ids VALUES (?, ?)', (str(event_id), time_ms))
+        return cursor.rowcount == 1
+
+    def prune(self, before_ms):
+        """
+        Forget the ids of events from before the given time.
+        """
+        self.connection.execute('DELETE FROM event_ids WHERE time_ms < ?', (before_ms,))
+
+    def get_watermark(self, event_type):
+        """
+        Return the time (epoch ms) up to which events of this type have been
+        polled, or None if they never have been.
+        """
+        row = self.connection.execute('SELECT time_ms FROM watermarks WHERE event_type = ?', (event_type,)).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, event_type, time_ms):
+        self.connection.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?)', (event_type, time_ms))
+
+    def commit(self):
+        self.connection.commit()
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM event_ids').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class EventStore(object):
+    """
+    Exported events, kept as json lines in gzip-compressed segment files that
+    each hold --segment-minutes of event time, listed in a small manifest.
+    Segments whose events are all older than the retention period are
+    deleted by compact().  Only the writer thread appends to the store.
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, directory='events', segment_minutes=60, retention_days=7):
+        self.directory = directory
+        self.segment_ms = segment_minutes * 60 * 1000
+        self.retention_ms = retention_days * 24 * 60 * 60 * 1000 if retention_days else None
+
+        os.makedirs(directory, exist_ok=True)
+
+        # segment filename -> {'start': ms, 'end': ms, 'events': count, 'appends': count}
+        self.manifest = {}
+        manifest_path = os.path.join(directory, self.MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as fp:
+                self.manifest = json.load(fp)
+
+    def save_manifest(self):
+        manifest_path = os.path.join(self.directory, self.MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as fp:
+            json.dump(self.manifest, fp, indent=1, sort_keys=True)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def segments(self):
+        """
+        Return the segment filenames, oldest first.
+        """
+        return sorted(self.manifest, key=lambda name: self.manifest[name]['start'])
+
+    def append(self, events):
+        """
+        Write the events to the segments for their event times.  Every gzip
+        append adds a member to the file; compact() merges them later.
+        """
+        now = int(time.time() * 1000)
+        lines_by_start = {}
+        for event in events:
+            event_time = event.get('eventTime') or now
+            start = event_time - event_time % self.segment_ms
+            lines_by_start.setdefault(start, []).append(json.dumps(event) + "\n")
+
+        for start, lines in lines_by_start.items():
+            name = 'events-{}.json.gz'.format(datetime.fromtimestamp(start / 1000.0, timezone.utc).strftime('%Y%m%dT%H%M'))
+            segment = self.manifest.get(name)
+            if segment is None:
+                # listed before it is written, so that it can't be left out
+                segment = self.manifest[name] = {'start': start, 'end': start + self.segment_ms, 'events': 0, 'appends': 0}
+                self.save_manifest()
+
+            with gzip.open(os.path.join(self.directory, name), 'at') as fp:
+                fp.writelines(lines)
+            segment['events'] += len(lines)
+            segment['appends'] += 1
+
+        if lines_by_start:
+            self.save_manifest()
+
+    def read_lines(self):
+        """
+        Yield the stored events as json lines, segment by segment, oldest
+        segment first, without reading a whole segment into memory.
+        """
+        for name in self.segments():
+            try:
+                with gzip.open(os.path.join(self.directory, name), 'rt') as fp:
+                    for line in fp:
+                        yield line
+            except (OSError, EOFError) as e:
+                # a segment cut short by a crash still yields what was written
+                print("Skipping rest of segment {0}: {1}".format(name, str(e)))
+
+    def compact(self):
+        """
+        Delete the segments past the retention period, and rewrite each
+        segment that is no longer being appended to as a single gzip member.
+        Returns the retention cutoff (epoch ms), or None if events are kept
+        forever.
+        """
+        now = int(time.time() * 1000)
+        cutoff = now - self.retention_ms if self.retention_ms else None
+
+        for name in self.segments():
+            segment = self.manifest[name]
+            path = os.path.join(self.directory, name)
+            if cutoff is not None and segment['end'] <= cutoff:
+                del self.manifest[name]
+                self.save_manifest()
+                if os.path.exists(path):
+                    os.remove(path)
+            elif segment['appends'] > 1 and segment['end'] + self.segment_ms <= now:
+                with gzip.open(path, 'rb') as src, gzip.open(path + '.tmp', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(path + '.tmp', path)
+                segment['appends'] = 1
+                self.save_manifest()
+
+        return cutoff
+
+    def count(self):
+        return sum(segment['events'] for segment in self.manifest.values())
+
+    def import_legacy(self, filename='events.json', lines_per_batch=CSV_ROWS_PER_WRITE):
+        """
+        Move the events from the events.json file kept by older versions of
+        this script into the store.
+        """
+        if not os.path.exists(filename):
+            return
+        with open(filename, 'r') as fp:
+            events = []
+            for line in fp:
+                if line.strip():
+                    events.append(json.loads(line))
+                if len(events) >= lines_per_batch:
+                    self.append(events)
+                    events = []
+            self.append(events)
+        os.remove(filename)
+
+
+class EventCollector(threading.Thread):
+    """
+    Polls the events of a single type, starting from that type's watermark,
+    and hands them to the writer thread.  Each poll ends with a batch that
+    carries the poll time, which the writer records as the new watermark
+    once everything before it has been written.
+    """
+    def __init__(self, args, event_type, watermark, event_queue):
+        super().__init__(name='collector-{}'.format(event_type), daemon=True)
         self.running = True
         self.args = args
+        self.event_type = event_type
+        self.watermark = watermark
+        self.event_queue = event_queue
+        self.wakeup = threading.Event()
 
     def stop(self):
         self.running = False
+        self.wakeup.set()
 
     def run(self):
-        new_events = 0
-        total_events_grabbed = 0
+        # one pooled connection for every poll
+        session = requests.Session()
+        session.headers.update({'X-Auth-Token': "{0}/{1}".format(self.args.api_key, self.args.connector_id)})
+
+        poll_interval = POLL_INTERVAL_MIN
 
         while (self.running):
+            poll_events_found = False
             try:
-                event_ids = import_event_ids()
+                # only ask for events since the last complete poll, going back
+                # a little further to pick up events the server indexed late
+                poll_time = int(time.time() * 1000)
+                if self.watermark is None:
+                    params = {'searchWindow': INITIAL_SEARCH_WINDOW}
+                else:
+                    params = {'startTime': format_event_time(self.watermark - self.args.watermark_overlap * 1000),
+                              'endTime': format_event_time(poll_time)}
+                params['eventType'] = self.event_type
+
+                batch = []
+                for event in poll_events(session, self.args.defense_api_url, params):
+                    # events from the overlap were already seen by the last poll
+                    if self.watermark is None or event.get('eventTime', poll_time) >= self.watermark:
+                        poll_events_found = True
+                    batch.append(event)
+                    if len(batch) >= EVENT_ROWS_PER_PAGE:
+                        self.event_queue.put((self.event_type, batch, None))
+                        batch = []
+
+                self.event_queue.put((self.event_type, batch, poll_time))
+                self.watermark = poll_time
             except Exception as e:
-                event_ids = []
+                traceback.print_exc()
 
-            try:
-                response = request_events(args.defense_api_url, args.connector_id, args.api_key)
+            if poll_events_found:
+                poll_interval = max(POLL_INTERVAL_MIN, poll_interval // 2)
+            else:
+                poll_interval = min(POLL_INTERVAL_MAX, poll_interval * 2)
+            self.wakeup.wait(poll_interval)
+
+        session.close()
+
+
+class EventWriter(threading.Thread):
+    """
+    The only thread that touches the event history.  Takes the batches of
+    events queued by the collectors, drops the ones already exported, appends
+    the rest to the event store and commits their ids along with the
+    collectors' watermarks.  A None on the queue stops it.
+    """
+    def __init__(self, event_queue, store):
+        super().__init__(name='writer')
+        self.event_queue = event_queue
+        self.store = store
+        self.new_events = 0
+
+    def run(self):
+        # opened here, as sqlite connections belong to the thread that opens them
+        event_ids = EventIdIndex()
+        last_compaction = 0
+
+        while True:
+            item = self.event_queue.get()
+            if item is None:
+                break
 
-                for event in response.get('results', []):
-                    total_events_grabbed += 1
+            event_type, events, poll_time = item
+            try:
+                # events without a time are indexed as of now, so that
+                # retention still prunes them; only the last batch of a
+                # poll carries the poll time
+                received_time = poll_time or int(time.time() * 1000)
+                new_events = []
+                for event in events:
                     event_id = event.get('eventId', None)
                     if event_id is None:
                         continue
-                    elif event_id in event_ids:
+                    elif not event_ids.add(event_id, event.get('eventTime') or received_time):
                         continue
                     else:
-                        new_events += 1
-                        event_ids.append(event_id)
-                        dump_event(json.dumps(event) + "\n")
-                        dump_event_id(str(event_id) + "\n")
-
-                sys.stdout.write("\rNew events count:{}".format(new_events))
-                sys.stdout.flush()
-                # print("\rTotal events received:{}".format(total_events_grabbed))
-                # print("New events count:{}".format(new_events))
-                # print("Total events saved in history:{}".format(total_event_count()))
-                # print("Total event ids saved in history:{}".format(total_event_id_count()))
+                        new_events.append(event)
+                self.store.append(new_events)
+                self.new_events += len(new_events)
+
+                if poll_time is not None:
+                    # every event of this type up to the start of the poll
+                    # has now been seen; the ids and the watermark are only
+                    # committed once their events have been written
+                    event_ids.set_watermark(event_type, poll_time)
+
+                    if time.time() - last_compaction >= COMPACTION_INTERVAL:
+                        cutoff = self.store.compact()
+                        if cutoff is not None:
+                            event_ids.prune(cutoff)
+                        last_compaction = time.time()
+
+                    event_ids.commit()
+
+                    sys.stdout.write("\rNew events count:{}".format(self.new_events))
+                    sys.stdout.flush()
             except Exception as e:
                 traceback.print_exc()
 
-            time.sleep(5)
+        event_ids.commit()
+        event_ids.close()
+
+
+def format_event_time(time_ms):
+    return datetime.fromtimestamp(time_ms / 1000.0, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def poll_events(session, api_url_root, params):
+    """
+    Yield every event matching the params, a page at a time, so that bursts
+    of more than one page of events are not missed.
+    """
+    start = 0
+    while True:
+        page_params = dict(params, start=start, rows=EVENT_ROWS_PER_PAGE)
+        response = request_events(session, api_url_root, page_params)
+        if response is None:
+            raise Exception("Failed to retrieve events")
+
+        results = response.get('results', []) or []
+        for event in results:
+            yield event
 
+        start += len(results)
+        total_results = response.get('totalResults')
+        if len(results) < EVENT_ROWS_PER_PAGE or (total_results is not None and start >= total_results):
+            break
 
-def request_events(api_url_root, connector_id, api_key):
-    headers = {'X-Auth-Token': "{0}/{1}".format(api_key, connector_id)}
 
+def request_events(session, api_url_root, params):
     try:
-        response = requests.get(
-            "{0}/integrationServices/v3/event?searchWindow=3h&rows=5000&eventType=NETWORK".format(api_url_root),
-            headers=headers,
+        response = session.get(
+            "{0}/integrationServices/v3/event".format(api_url_root),
+            params=params,
             timeout=API_TIMEOUT_DEFAULT)
     except Exception as e:
         print("Exception {0} when retrieving events".format(str(e)))
@@ -103,85 +449,90 @@ def request_events(api_url_root, connector_id, api_key):
     return response.json()
 
 
-def dump_event(data):
-    with open('events.json', 'a') as fp:
-        fp.write(data)
+def compile_field_extractor(fields):
+    """
+    Build a function that returns the csv row for an event, given
+    (column, key path, default) fields.  Missing or null values are
+    replaced by the default.
+    """
+    paths = tuple((path[0], path[1:], default) for column, path, default in fields)
+
+    def extract(event):
+        row = []
+        for first_key, other_keys, default in paths:
+            value = event.get(first_key)
+            for key in other_keys:
+                if not isinstance(value, dict):
+                    value = None
+                    break
+                value = value.get(key)
+            row.append(default if value is None else value)
+        return row
+
+    return extract
+
+
+def export_to_csv(store, output_file='event_export.csv'):
+    """
+    Convert the stored events to csv, parsing each event exactly once and
+    writing the rows in large batches.  The segments are streamed, not read
+    into memory.
+    """
+    extract = compile_field_extractor(EXPORT_FIELDS)
+    with open(output_file, 'w', newline='', buffering=CSV_BUFFER_SIZE) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([column for column, path, default in EXPORT_FIELDS])
+        rows = []
+        for line in store.read_lines():
+            rows.append(extract(json.loads(line)))
+            if len(rows) >= CSV_ROWS_PER_WRITE:
+                writer.writerows(rows)
+                rows = []
+        writer.writerows(rows)
 
 
-def import_event_ids():
-    event_ids = []
-    with open('event_ids.json', 'r') as fp:
-        for line in fp.readlines():
-            event_ids.append(line.strip())
-    return event_ids
-
-
-def dump_event_id(data):
-    with open('event_ids.json', 'a') as fp:
-        fp.write(data)
-
+def main(args):
+    print('[+] Starting event export script')
+    print('[+] Running this script for {} minute(s)'.format(args.minutes))
 
-def total_event_count():
-    try:
-        with open('events.json', 'r') as fp:
-            return len(fp.readlines())
-    except Exception as e:
-        print(str(e))
-        return 0
+    if args.reset:
+        for filename in ("events.json", "event_ids.db", "event_ids.json"):
+            try:
+                os.remove(filename)
+            except Exception as e:
+                print(str(e))
+        shutil.rmtree(args.event_dir, ignore_errors=True)
 
+    event_types = [event_type.strip().upper() for event_type in args.event_types.split(',') if event_type.strip()]
 
-def total_event_id_count():
     try:
-        with open('event_ids.json', 'r') as fp:
-            return len(fp.readlines())
-    except Exception as e:
-        print(str(e))
-        return 0
-
-
-def export_to_csv():
-    with open('event_export.csv', 'w') as csvfile:
-        with open('events.json', 'r') as fp:
-            fieldnames = ['eventId', 'sourceAddress', 'destAddress', 'threatIndicators', 'deviceName',
-                          'parentName', 'name', 'appName', 'targetAppName', 'parentAppName']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for line in fp.readlines():
-                threatIndicators = json.loads(line).get('threatIndicators', [])
-                if not threatIndicators:
-                    threatIndicators = []
-                writer.writerow({'eventId': json.loads(line).get('eventId', ''),
-                                 'sourceAddress': json.loads(line).get('netFlow', {}).get('sourceAddress', ''),
-                                 'destAddress': json.loads(line).get('netFlow', {}).get('destAddress', ''),
-                                 'threatIndicators': threatIndicators,
-                                 'deviceName': json.loads(line).get('deviceDetails', {}).get('deviceName', ''),
-                                 'parentName': json.loads(line).get('processDetails', {}).get('parentName', ''),
-                                 'name': json.loads(line).get('processDetails', {}).get('name', ''),
-                                 'appName': json.loads(line).get('selectedApp', {}).get('applicationName', ''),
-                                 'targetAppName': json.loads(line).get('targetApp', {}).get('applicationName', ''),
-                                 'parentAppName': json.loads(line).get('parentApp', {}).get('applicationName', '')})
-
+        store = EventStore(args.event_dir, args.segment_minutes, args.retention_days)
+        store.import_legacy()
 
-def main(args):
-    print('[+] Starting event export script')
-    print('[+] Running this script for {} minute(s)'.format(args.minutes))
+        # each collector resumes from its own event type's watermark
+        event_ids = EventIdIndex()
+        watermarks = dict((event_type, event_ids.get_watermark(event_type)) for event_type in event_types)
+        event_ids.close()
 
-    try:
-        if args.reset:
-            os.remove("events.json")
-            os.remove("event_ids.json")
-    except Exception as e:
-        print(str(e))
+        event_queue = queue.Queue(EVENT_QUEUE_SIZE)
+        writer = EventWriter(event_queue, store)
+        writer.start()
 
-    try:
-        event_thread = EventThread(args)
-        event_thread.start()
+        collectors = [EventCollector(args, event_type, watermarks[event_type], event_queue)
+                      for event_type in event_types]
+        for collector in collectors:
+            collector.start()
 
         time.sleep(args.minutes * 60)
-        event_thread.stop()
-        event_thread.join()
-        print('\n[+] Exporting events to event_export.csv')
-        export_to_csv()
+        for collector in collectors:
+            collector.stop()
+        for collector in collectors:
+            collector.join()
+
+        event_queue.put(None)
+        writer.join()
+        print('\n[+] Exporting events to {}'.format(args.output_file))
+        export_to_csv(store, args.output_file)
         print('[+] Done')
     except:
         print("[-] Error")
@@ -204,7 +555,7 @@ if __name__ == "__main__":
                         help='API Key for API connector')
 
     parser.add_argument('--output_file',
-                        default="events_export.csv",
+                        default="event_export.csv",
                         help="output csv file")
 
     parser.add_argument('--reset',
@@ -212,6 +563,29 @@ if __name__ == "__main__":
                         default=False,
                         help="delete event history")
 
+    parser.add_argument('--event-types',
+                        default="NETWORK",
+                        help="comma separated event types to export, e.g. NETWORK,FILE,REGISTRY,PROCESS")
+
+    parser.add_argument('--watermark-overlap',
+                        type=int,
+                        default=600,
+                        help="seconds before the last poll to search from, for events the server indexes late")
+
+    parser.add_argument('--event-dir',
+                        default="events",
+                        help="directory to keep the exported events in")
+
+    parser.add_argument('--segment-minutes',
+                        type=int,
+                        default=60,
+                        help="minutes of event time kept in each compressed event file")
+
+    parser.add_argument('--retention-days',
+                        type=int,
+                        default=7,
+                        help="days to keep events and event ids for; 0 keeps them forever")
+
     parser.add_argument('--minutes',
                         type=int,
                         default=1,
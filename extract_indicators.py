@@ -31,10 +31,12 @@
 #
 
 import sys
-import struct
-import socket
 import optparse
 import cbapi
+import numpy
+
+import netconn_helpers
+from checkpoint_helpers import Checkpoint
 
 def build_cli_parser():
     parser = optparse.OptionParser(usage="%prog [options]", description="Dump Binary Info")
@@ -47,6 +49,12 @@ def build_cli_parser():
                       help="API Token for Carbon Black server")
     parser.add_option("-n", "--no-ssl-verify", action="store_false", default=True, dest="ssl_verify",
                       help="Do not verify server SSL certificate.")
+    parser.add_option("-k", "--checkpoint", action="store", default=None, dest="checkpoint",
+                      help="File to periodically save progress to, so that an interrupted run can be resumed")
+    parser.add_option("--checkpoint-interval", action="store", default=60, dest="checkpoint_interval", type="int",
+                      help="Minimum number of seconds between checkpoints (default 60)")
+    parser.add_option("-R", "--resume", action="store_true", default=False, dest="resume",
+                      help="Resume from the last checkpoint saved to the --checkpoint file")
     return parser
 
 def main(argv):
@@ -58,6 +66,9 @@ def main(argv):
     if not opts.url or not opts.token:
         print "Missing required param; run with --help for usage"
         sys.exit(-1)
+    if opts.resume and not opts.checkpoint:
+        print "--resume requires a --checkpoint file"
+        sys.exit(-1)
 
     # build a cbapi object
     #
@@ -73,11 +84,32 @@ def main(argv):
     ips = set()
     domains = set()
 
+    # the binary index is searched first, then the process index
+    #
+    phase = 'binaries'
+
+    # periodically save the phase, the start row and the indicators found
+    # so far, so that an interrupted run can pick up where it left off
+    #
+    checkpoint = None
+    if opts.checkpoint:
+        checkpoint = Checkpoint(opts.checkpoint, opts.checkpoint_interval)
+
+    if opts.resume:
+        state = checkpoint.load()
+        if state is not None:
+            phase = state['phase']
+            start = state['start']
+            md5s = state['md5s']
+            ips = state['ips']
+            domains = state['domains']
+            print "Resuming %s search from row %d" % (phase, start)
+
     # extract all md5s from the binary index (cbmodules)
     # this is equivalent to the "Search Binaries" capability
     # in the web ui
     #
-    while True:
+    while phase == 'binaries':
 
         # perform an unqualified search of the binary index,
         # paging as necessary
@@ -102,8 +134,14 @@ def main(argv):
         # 
         start = start + rows
 
-    start = 0
-    rows = 250 
+        if checkpoint:
+            checkpoint.save({'phase': phase, 'start': start, 'md5s': md5s, 'ips': ips, 'domains': domains})
+
+    # the binary index is complete; start on the process index
+    #
+    if phase == 'binaries':
+        phase = 'processes'
+        start = 0
 
     # iterate over all process documents that have at least one netconn
     # event.  this search returns documents from the 'cbevents' index,
@@ -145,49 +183,48 @@ def main(argv):
             #
             events = cb.process_events(process['id'], process['segment_id'])
 
-            # iterate over each netconn event in the process document
+            # decode every netconn event in the process document in one pass
+            #
+            # the netconn event format is a single string with six fields, with a | delimiter
+            # the fields are as follows:
+            # 
+            # <!-- NETCONNS - expected to be "(TIME) | (IP) | (PORT) | (PROTOCOL) | (domain) | (direction)" -->
+            # <!--                            2013-02-08 14:44:06.000000|460258477|20480|1|facebook.com|1 -->
+            #
+            # events without six and only six fields are skipped by the decoder
+            #
+            netconns, netconn_domains = netconn_helpers.decode_netconns(events['process'].get('netconn_complete', []))
+
+            # extract the distinct ips and convert each to a string represenation
+            # 
+            # the IP may be missing in certain cases, most notably a web proxy scenario
+            # 
+            for ip in numpy.unique(netconns['ip']):
+                if ip != 0:
+                    ips.add(netconn_helpers.int_to_ip(ip))
+
+            # the decoder has already reduced the domain field to the distinct
+            # domain names
             #
-            for netconn in events['process']['netconn_complete']:
-           
-                # the netconn event format is a single string with six fields, with a | delimiter
-                # the fields are as follows:
-                # 
-                # <!-- NETCONNS - expected to be "(TIME) | (IP) | (PORT) | (PROTOCOL) | (domain) | (direction)" -->
-                # <!--                            2013-02-08 14:44:06.000000|460258477|20480|1|facebook.com|1 -->
-                #
-                # split the netconn event into individual fields, validating that
-                # six and only six fields are present
-                #
-                netconn_fields = netconn.split('|')
-                if len(netconn_fields) != 6:
-                    continue
-
-                # extract the ip field (32bit unsigned int representation of the IPv4
-                # address) and convert to a string represenation of the IP
-                # 
-                # the IP may be missing in certain cases, most notably a web proxy scenario
-                # 
-                ip = netconn_fields[1]
-                if len(ip) > 0:
-                    try:
-                        ip = socket.inet_ntoa(struct.pack("!i", int(ip)))
-                        ips.add(ip)
-                    except Exception, e:
-                        pass 
-
-                # extract the domain field
-                #
-                # the domain name field may be missing in certain cases, most notably
-                # when the connection was made directly to an IP
-                #
-                domain = netconn_fields[4]
+            # the domain name field may be missing in certain cases, most notably
+            # when the connection was made directly to an IP
+            #
+            for domain in netconn_domains:
                 if len(domain) > 0:
                     domains.add(domain)
                 
         start = start + rows
 
+        if checkpoint:
+            checkpoint.save({'phase': phase, 'start': start, 'md5s': md5s, 'ips': ips, 'domains': domains})
+
         print start 
 
+    # the search is complete; there is nothing left to resume
+    #
+    if checkpoint:
+        checkpoint.remove()
+
     print "# %-10s | %s" % ('IOC', 'Count')
     print "# %-10s + %s" % ('-' * 10, '-' * 10)
     print "# %-10s | %s" % ('md5', len(md5s))
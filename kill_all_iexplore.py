@@ -32,28 +32,32 @@
 
 try:
     from cbapi.legacy.util.cli_helpers import main_helper
-    from cbapi.legacy.util.live_response_helpers import LiveResponseHelper
 except ImportError:
     from cbapi.util.cli_helpers import main_helper
-    from cbapi.util.live_response_helpers import LiveResponseHelper
 
-def main(cb, args):
-    sensor_id = int(args.get('sensorid'))
-    lrh = LiveResponseHelper(cb, sensor_id)
-    lrh.start()
+import lr_fleet_helpers
 
+def kill_iexplore(lrh, sensor):
     # THIS COULD EASILY BE TURNED INTO A LOOP SO THAT YOU CONTINUOUSLY POLL FOR A SPECIFIC PROCESS AND KILL IT
+    killed = []
     processes = lrh.process_list()
     for process in processes:
         path = process.get('path')
         if path.lower().endswith('iexplore.exe'):
             lrh.kill(process.get('pid'))
-            print "Killed: %s|%s|%s" % (process.get('path'),
+            killed.append(process)
+    return killed
+
+def report(sensor, killed):
+    for process in killed:
+        print "%s: Killed: %s|%s|%s" % (lr_fleet_helpers.describe(sensor),
+                                        process.get('path'),
                                         process.get('command_line', ''),
                                         process.get('username', ''))
 
-    lrh.stop()
+def main(cb, args):
+    lr_fleet_helpers.run_on_sensors(cb, args, kill_iexplore, report)
 
 if __name__ == "__main__":
-    required_arg = ("-s", "--sensorid", "store", None, "sensorid", "Sensor id")
-    main_helper("Kill all iexplore.exe processes on particular sensor", main, custom_required=[required_arg])
+    main_helper("Kill all iexplore.exe processes on particular sensors", main,
+                custom_optional=lr_fleet_helpers.FLEET_OPTIONS)
@@ -0,0 +1,259 @@
+#
+#The MIT License (MIT)
+#
+# Copyright (c) 2016 Carbon Black
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# -----------------------------------------------------------------------------
+#  Live response across many sensors
+#
+#  kill_all_iexplore, put_file and del_file run one live response action on
+#  the sensors picked on the command line: a list of sensor ids, a file of
+#  them, or the sensors matching a hostname or sensor group.  A FleetExecutor
+#
+#   - runs the action on a pool of worker threads, so at most that many
+#     sensors are being worked on at once,
+#   - sets the sensors that are offline aside, and retries them as they come
+#     back online, until the retry timeout,
+#   - retries a sensor whose session does not become ready in time only a
+#     few times, since each try leaves another pending session on the server,
+#   - reports each sensor's result as soon as it finishes.
+#
+#  The legacy API has no way to close a session.  Once a sensor is done, or
+#  its session was not ready in time, its session is no longer kept alive,
+#  and is left for the server to time out.
+#
+#  Actions are called as action(lrh, sensor), with a ready LiveResponseHelper
+#  and the sensor's record from the server, and whatever they return is passed
+#  on as report(sensor, result).
+#
+
+import sys
+import time
+import threading
+import Queue
+
+try:
+    from cbapi.legacy.util.live_response_helpers import LiveResponseHelper
+except ImportError:
+    from cbapi.util.live_response_helpers import LiveResponseHelper
+
+
+FLEET_OPTIONS = [
+    ("-s", "--sensorid", "store", None, "sensorid", "Sensor id, or a comma separated list of sensor ids"),
+    ("-S", "--sensor-file", "store", None, "sensor_file", "File of sensor ids, one per line"),
+    ("-H", "--hostname", "store", None, "hostname", "Act on the sensors whose hostname contains this"),
+    ("-g", "--groupid", "store", None, "groupid", "Act on the sensors in this sensor group"),
+    ("-w", "--workers", "store", 10, "workers", "Number of sensors to act on at once (default 10)"),
+    ("-t", "--session-timeout", "store", 120, "session_timeout",
+     "Seconds to wait for a sensor's live response session before retrying it later (default 120)"),
+    ("-T", "--session-retries", "store", 2, "session_retries",
+     "Times to retry a sensor whose live response session was not ready in time (default 2)"),
+    ("-R", "--retry-timeout", "store", 3600, "retry_timeout",
+     "Seconds to keep retrying offline sensors for (default 3600)")]
+
+
+def describe(sensor):
+    return "%s (%d)" % (sensor.get('computer_name', '').strip(), sensor['id'])
+
+
+def is_online(sensor):
+    return sensor.get('status') == "Online"
+
+
+class FleetExecutor(object):
+    def __init__(self, cb, action, workers=10, session_timeout=120, session_retries=2, retry_interval=60,
+                 retry_timeout=3600):
+        self.cb = cb
+        self.action = action
+        self.workers = workers
+        self.session_timeout = session_timeout
+        self.session_retries = session_retries
+        self.retry_interval = retry_interval
+        self.retry_timeout = retry_timeout
+
+        self.work_queue = Queue.Queue()
+        self.result_queue = Queue.Queue()
+
+    def run(self, sensors, report):
+        """
+        Run the action on each of the sensors, calling report(sensor, result)
+        from this thread as each one finishes.  Returns the number of sensors
+        the action succeeded on, failed on, and that stayed offline.
+        """
+        deadline = time.time() + self.retry_timeout
+        next_retry = min(time.time() + self.retry_interval, deadline)
+
+        # sensor id -> sensor, for the sensors waiting to be retried, and
+        # sensor id -> number of times its session was not ready in time
+        waiting = {}
+        unready = {}
+        outstanding = 0
+        for sensor in sensors:
+            if is_online(sensor):
+                self.work_queue.put(sensor)
+                outstanding += 1
+            else:
+                waiting[sensor['id']] = sensor
+
+        if waiting:
+            print "[*] %d sensors are offline, will retry them for up to %d seconds" % (len(waiting),
+                                                                                       self.retry_timeout)
+
+        workers = []
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.work)
+            worker.start()
+            workers.append(worker)
+
+        succeeded = failed = offline = 0
+        while outstanding or waiting:
+            try:
+                sensor, status, result = self.result_queue.get(timeout=1.0)
+            except Queue.Empty:
+                pass
+            else:
+                outstanding -= 1
+                if status == 'unready':
+                    unready[sensor['id']] = unready.get(sensor['id'], 0) + 1
+                    if unready[sensor['id']] > self.session_retries:
+                        print "[!] %s: live response session not ready, giving up" % describe(sensor)
+                        offline += 1
+                    else:
+                        waiting[sensor['id']] = sensor
+                elif status == 'error':
+                    print "[!] %s: %s" % (describe(sensor), result)
+                    failed += 1
+                else:
+                    report(sensor, result)
+                    succeeded += 1
+
+            now = time.time()
+            if not waiting or now < next_retry:
+                continue
+
+            if now >= deadline:
+                for sensor in waiting.values():
+                    print "[!] %s: offline, giving up" % describe(sensor)
+                    offline += 1
+                waiting.clear()
+                continue
+
+            # one request for the whole fleet, rather than one per sensor
+            try:
+                for sensor in self.cb.sensors():
+                    if sensor['id'] in waiting and is_online(sensor):
+                        del waiting[sensor['id']]
+                        self.work_queue.put(sensor)
+                        outstanding += 1
+            except Exception, e:
+                print "[!] Could not refresh the sensor status: %s" % e
+            next_retry = min(now + self.retry_interval, deadline)
+
+        for worker in workers:
+            self.work_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+        return succeeded, failed, offline
+
+    def work(self):
+        while True:
+            sensor = self.work_queue.get()
+            if sensor is None:
+                return
+
+            lrh = LiveResponseHelper(self.cb, sensor['id'])
+            lrh.start()
+            try:
+                # the session stays pending until the sensor checks in
+                if not lrh.ready_event.wait(self.session_timeout):
+                    self.result_queue.put((sensor, 'unready', None))
+                    continue
+                result = self.action(lrh, sensor)
+            except Exception, e:
+                self.result_queue.put((sensor, 'error', e))
+            else:
+                self.result_queue.put((sensor, 'done', result))
+            finally:
+                lrh.stop(wait=False)
+
+
+def select_sensors(cb, args):
+    """
+    Return the sensors picked by the FLEET_OPTIONS given on the command line.
+    Sensors given by id that do not exist are reported and skipped; sensors
+    matched by hostname or group that have been uninstalled are skipped.
+    """
+    sensor_ids = set()
+    if args.get('sensorid'):
+        sensor_ids.update(int(sensor_id) for sensor_id in args['sensorid'].split(',') if sensor_id.strip())
+    if args.get('sensor_file'):
+        with open(args['sensor_file']) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    sensor_ids.add(int(line))
+
+    query = {}
+    if args.get('hostname'):
+        query['hostname'] = args['hostname']
+    if args.get('groupid'):
+        query['groupid'] = int(args['groupid'])
+
+    sensors = []
+    for sensor in cb.sensors(query):
+        if sensor_ids:
+            if sensor['id'] not in sensor_ids:
+                continue
+            sensor_ids.discard(sensor['id'])
+        elif sensor.get('uninstalled'):
+            continue
+
+        if not sensor.get('supports_cblr', True):
+            print "[!] %s: does not support live response" % describe(sensor)
+            continue
+        sensors.append(sensor)
+
+    for sensor_id in sorted(sensor_ids):
+        print "[!] Sensor %d not found" % sensor_id
+    return sensors
+
+
+def run_on_sensors(cb, args, action, report):
+    """
+    Run the action on the sensors picked on the command line, and print a
+    summary once they are all done.
+    """
+    if not (args.get('sensorid') or args.get('sensor_file') or args.get('hostname') or args.get('groupid')):
+        print
+        print "** Pick the sensors with --sensorid, --sensor-file, --hostname or --groupid **"
+        print
+        sys.exit(-1)
+
+    sensors = select_sensors(cb, args)
+    print "[*] Acting on %d sensors" % len(sensors)
+
+    executor = FleetExecutor(cb, action, workers=int(args.get('workers')),
+                             session_timeout=int(args.get('session_timeout')),
+                             session_retries=int(args.get('session_retries')),
+                             retry_timeout=int(args.get('retry_timeout')))
+    succeeded, failed, offline = executor.run(sensors, report)
+    print "[*] Done: %d succeeded, %d failed, %d offline" % (succeeded, failed, offline)
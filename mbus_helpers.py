@@ -0,0 +1,233 @@
+#
+#The MIT License (MIT)
+#
+# Copyright (c) 2016 Carbon Black
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# -----------------------------------------------------------------------------
+#  Shared message bus consumer
+#
+#  The scripts that act on message bus events (auto_blacklist_from_watchlist,
+#  auto_isolate_from_watchlist, move_policy_from_mbus) all consume from the
+#  Carbon Black Server's RabbitMQ on port 5004.  A MessageBusConsumer sets up
+#  the connection and the queue for them, and
+#
+#   - limits the unacknowledged messages the server sends (the prefetch),
+#   - hands each message to a pool of worker threads, so a slow handler does
+#     not hold up the channel,
+#   - acknowledges the handled messages in batches, from the consuming thread,
+#     since a pika channel may only be used by the thread that created it;
+#     a slow message does not hold up the acks of the ones after it,
+#   - optionally consumes from a durable, named queue, so no messages are lost
+#     while the script is restarted,
+#   - periodically prints the message rate, handler latency and backlog.
+#
+#  Message handlers are called as handler(routing_key, content_type, body).
+#
+
+import time
+import threading
+import Queue
+from ConfigParser import SafeConfigParser
+
+import pika
+
+
+class MessageBusConsumer(object):
+    def __init__(self, host, username, password, routing_keys, handler, exchange='api.events', port=5004,
+                 queue_name=None, prefetch=100, workers=4, ack_batch=50, ack_interval=1.0, stats_interval=60):
+        self.host = host
+        self.port = port
+        self.credentials = pika.PlainCredentials(username, password)
+        self.exchange = exchange
+        self.routing_keys = routing_keys
+        self.handler = handler
+
+        # without a queue name, the server names the queue, and deletes it
+        # (and the messages in it) when the script exits
+        self.queue_name = queue_name
+        self.prefetch = prefetch
+        self.workers = workers
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval
+        self.stats_interval = stats_interval
+
+        self.work_queue = Queue.Queue()
+        self.done_queue = Queue.Queue()
+
+        # every delivery tag up to this one has been acked; the tags handled
+        # but not acked yet, and those acked one at a time past a message
+        # still being handled
+        self.acked = 0
+        self.handled = set()
+        self.acked_ahead = set()
+        self.last_ack = time.time()
+
+        # counters since the last time the stats were printed
+        self.stats_lock = threading.Lock()
+        self.stats_start = time.time()
+        self.message_count = 0
+        self.error_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def run(self):
+        """
+        Consume messages until interrupted with Ctrl-C.
+        """
+        connection = pika.BlockingConnection(pika.ConnectionParameters(self.host, self.port, '/', self.credentials))
+        channel = connection.channel()
+
+        if self.queue_name:
+            result = channel.queue_declare(queue=self.queue_name, durable=True, auto_delete=False)
+        else:
+            result = channel.queue_declare(queue='', exclusive=True, auto_delete=True)
+        queue_name = result.method.queue
+
+        for routing_key in self.routing_keys:
+            channel.queue_bind(exchange=self.exchange, queue=queue_name, routing_key=routing_key)
+
+        channel.basic_qos(prefetch_count=self.prefetch)
+
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+        print "Consuming %s from queue %s" % (", ".join(self.routing_keys), queue_name)
+
+        try:
+            # wake up at least every ack interval, to ack and print stats even
+            # while no messages arrive
+            for method_frame, header_frame, body in channel.consume(queue_name, inactivity_timeout=self.ack_interval):
+                if method_frame is not None:
+                    self.work_queue.put((method_frame.delivery_tag, method_frame.routing_key,
+                                         header_frame.content_type, body))
+                self.ack_handled(channel)
+                self.print_stats(channel, queue_name)
+        except KeyboardInterrupt:
+            pass
+
+        self.ack_handled(channel, force=True)
+        channel.cancel()
+        connection.close()
+
+    def work(self):
+        while True:
+            delivery_tag, routing_key, content_type, body = self.work_queue.get()
+            start = time.time()
+            error = False
+            try:
+                self.handler(routing_key, content_type, body)
+            except Exception, e:
+                print e
+                error = True
+
+            latency = time.time() - start
+            with self.stats_lock:
+                self.message_count += 1
+                self.error_count += error
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+            # every message is acked, whether or not its handler succeeded,
+            # so that none are left un-acked in the queue
+            self.done_queue.put(delivery_tag)
+
+    def ack_handled(self, channel, force=False):
+        """
+        Ack the messages handled so far, once a batch of them is ready or
+        the ack interval has passed.  Workers finish out of order: the
+        messages up to the first one still being handled are acked with a
+        single multiple=True ack, and the ones handled after it are acked
+        one at a time, so that a slow message does not keep them counting
+        against the prefetch.
+        """
+        while True:
+            try:
+                self.handled.add(self.done_queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        if not self.handled:
+            return
+        if not (force or len(self.handled) >= self.ack_batch or time.time() - self.last_ack >= self.ack_interval):
+            return
+
+        last = None
+        while True:
+            tag = self.acked + 1
+            if tag in self.handled:
+                self.handled.remove(tag)
+                last = tag
+            elif tag in self.acked_ahead:
+                self.acked_ahead.remove(tag)
+            else:
+                break
+            self.acked = tag
+        if last is not None:
+            channel.basic_ack(delivery_tag=last, multiple=True)
+
+        for tag in sorted(self.handled):
+            channel.basic_ack(delivery_tag=tag)
+        self.acked_ahead.update(self.handled)
+        self.handled.clear()
+        self.last_ack = time.time()
+
+    def print_stats(self, channel, queue_name):
+        now = time.time()
+        if not self.stats_interval or now - self.stats_start < self.stats_interval:
+            return
+
+        # the messages still on the server, plus the ones sent to this
+        # script that have not been handled yet
+        backlog = channel.queue_declare(queue=queue_name, passive=True).method.message_count
+        backlog += self.work_queue.qsize()
+
+        with self.stats_lock:
+            elapsed = now - self.stats_start
+            average = self.latency_total / self.message_count if self.message_count else 0.0
+            print "%d messages (%.1f/sec), %d errors, handler latency avg %.1f ms max %.1f ms, backlog %d" % (
+                self.message_count, self.message_count / elapsed, self.error_count,
+                average * 1000, self.latency_max * 1000, backlog)
+
+            self.stats_start = now
+            self.message_count = 0
+            self.error_count = 0
+            self.latency_total = 0.0
+            self.latency_max = 0.0
+
+
+def consumer_options(filename):
+    """
+    Read the optional consumer settings from the [settings] section of a
+    script's config file, as keyword arguments for MessageBusConsumer.
+    """
+    parser = SafeConfigParser()
+    parser.read(filename)
+
+    options = {}
+    if parser.has_option("settings", "queuename"):
+        options['queue_name'] = parser.get("settings", "queuename")
+    for option, name in (("prefetch", "prefetch"), ("workers", "workers"), ("ackbatch", "ack_batch"),
+                         ("statsinterval", "stats_interval")):
+        if parser.has_option("settings", option):
+            options[name] = parser.getint("settings", option)
+    return options
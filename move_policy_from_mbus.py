@@ -33,99 +33,185 @@
 #
 
 
-import pika
-import random
 import json
 import requests
 import sys
 from ConfigParser import SafeConfigParser
+from mbus_helpers import MessageBusConsumer, consumer_options
 import event_helpers as pbuf
 import re
 import time
+import threading
 from datetime import datetime
+from collections import OrderedDict
 import cbapi
 import bit9api
 
+# characters that make a trigger pattern more than a plain substring
+REGEX_SPECIAL_CHARACTERS = set(".^$*+?{}[]\\|()")
+
+class TriggerRules(object):
+    """
+    The trigger sections of the config file, compiled once at startup.
+
+    Every regex is compiled up front.  Within a section, plain substring
+    tests are checked before regexes, and shorter patterns before longer
+    ones, stopping at the first test that fails.  Each message field is
+    lowercased at most once per message, however many sections test it.
+    """
+
+    def __init__(self, triggers):
+        # (target policy, [(criteria, substring, compiled regex)]) per section
+        self.policies = []
+
+        for section, trigger in triggers.iteritems():
+            if not trigger['rules']:
+                print "Warning: trigger %s has no regex_ tests; ignoring it" % (section)
+                continue
+
+            rules = []
+            for criteria, expression in trigger['rules']:
+                if REGEX_SPECIAL_CHARACTERS.isdisjoint(expression):
+                    rules.append((0, len(expression), criteria, expression, None))
+                else:
+                    rules.append((1, len(expression), criteria, None, re.compile(expression)))
+            rules.sort()
+
+            self.policies.append((trigger.get('targetpolicy', ''),
+                                  [(criteria, substring, regex) for cost, length, criteria, substring, regex in rules]))
+
+    def match(self, message):
+        """
+        Returns (True, target policy) for the first section whose tests all
+        match the message, or (False, "") if none do.  A message without a
+        field that a test needs does not match that section.
+        """
+        lowered = {}
+
+        for target_policy, rules in self.policies:
+            for criteria, substring, regex in rules:
+                value = lowered.get(criteria)
+                if value is None:
+                    value = message.get(criteria)
+                    if value is None:
+                        break
+                    if not isinstance(value, basestring):
+                        value = str(value)
+                    value = lowered[criteria] = value.lower()
+
+                if substring is not None:
+                    if substring not in value:
+                        break
+                elif not regex.search(value):
+                    break
+            else:
+                return True, target_policy
+
+        return False, ""
+
 def check_triggers(message):
     global action_triggers
-    return_value = False
-    target_policy = ""
-
-    for policy in action_triggers:
-#       Need to make a copy here cause globals :(
-        rules = list(action_triggers[policy]['rules'])
-        while rules:
-            criteria = rules.pop(0)
-            expression = rules.pop(0)
-            if re.search(expression, message[criteria].lower()):
-                return_value = True
-            else:
-                return_value = False
-                rules = []
-        
-        if return_value:
-            target_policy = action_triggers[policy]['targetpolicy']
-            break
 
-    return return_value,target_policy
+    return action_triggers.match(message)
+
+class PolicyMover(object):
+    """
+    Moves computers between Enterprise Protection policies through a single
+    shared API client.
+
+    Policy ids (by name) and computers (by Cb sensor id) are cached for
+    ttl seconds, and moves are made one at a time per sensor, so a burst of
+    trigger hits on one host looks the computer up once and moves it once;
+    the later hits find it already in the target policy.
+    """
+
+    def __init__(self, bit9, ttl=300):
+        self.bit9 = bit9
+        self.ttl = ttl
+
+        # key -> (time cached, value)
+        self.policies = {}
+        self.computers = {}
+
+        self.lock = threading.Lock()
+        self.sensor_locks = {}
+
+    def cached(self, cache, key, load):
+        """
+        Returns the cached value for key, calling load() for it if it is
+        missing or older than the ttl.
+        """
+        now = time.time()
+        with self.lock:
+            entry = cache.get(key)
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+
+        value = load()
+        with self.lock:
+            cache[key] = (now, value)
+        return value
+
+    def policy_id(self, policyName):
+        def load():
+            destPolicies = self.bit9.search('v1/policy', ['name:'+policyName])
+            if len(destPolicies)==0:
+                raise ValueError("Cannot find destination policy "+policyName)
+            return destPolicies[0]['id']
+
+        return self.cached(self.policies, policyName, load)
+
+    def sensor_computers(self, sensor):
+        def load():
+            destComputer = self.bit9.search('v1/computer', ['cbSensorId:'+str(sensor)])
+            if len(destComputer)==0:
+                raise ValueError("Cannot find computer for sensor "+str(sensor))
+            return destComputer
+
+        return self.cached(self.computers, sensor, load)
+
+    def move(self, sensor, targetPolicyName):
+        policyId = self.policy_id(targetPolicyName)
+
+        with self.lock:
+            sensor_lock = self.sensor_locks.setdefault(sensor, threading.Lock())
+
+        with sensor_lock:
+            for c in self.sensor_computers(sensor):
+                if c['policyId'] == policyId:
+                    continue
+
+                print "Moving computer %s from policy %s to policy %s" % (c['name'], c['policyName'], targetPolicyName)
+                moved = dict(c)
+                moved['policyId'] = policyId
+                self.bit9.update('v1/computer', moved)
+
+                # only once the update has gone through does the cached
+                # computer reflect the move
+                c['policyId'] = policyId
+                c['policyName'] = targetPolicyName
 
 def move_policy(sensor, targetPolicy):
-    global eptoken
-    global epserver
+    global policy_mover
 
-    bit9 = bit9api.bit9Api(
-        "https://"+epserver,  # Replace with actual Bit9 server URL
-        token=eptoken,
-        ssl_verify=False  # Don't validate server's SSL certificate. Set to True unless using self-signed cert on IIS
-    )
-    
     # policy to send the naughty host to
-    targetPolicyName = targetPolicy
-    destPolicies = bit9.search('v1/policy', ['name:'+targetPolicyName])
-    if len(destPolicies)==0:
-        raise ValueError("Cannot find destination policy "+targetPolicyName)
-
-    # find the computer id
-    destComputer = bit9.search('v1/computer', ['cbSensorId:'+str(sensor)])
-    if len(destComputer)==0:
-      raise ValueError("Cannot find computer named "+hostname)
-
-    for c in destComputer:
-      print "Moving computer %s from policy %s to policy %s" % (c['name'], c['policyName'], targetPolicyName)
-      c['policyId'] = destPolicies[0]['id']
-      bit9.update('v1/computer', c)
+    policy_mover.move(sensor, targetPolicy)
  
-def on_message(channel, method_frame, header_frame, body):
+def on_message(routing_key, content_type, body):
     """
     Callback function which filters out the feeds we care about.
+    The consumer acks every message once this returns.
     """
     global cbserver
     global cbtoken
 
-    try:
-        if "application/protobuf" == header_frame.content_type:
-            if method_frame. routing_key == 'ingress.event.process':
-                (sensor, message)  = pbuf.protobuf_to_obj_and_host(body)
-                (hit,policy) = check_triggers(message)
-		if hit:
-                  move_policy(sensor,policy)
-                  print "ingress.event.process consume"
-    except Exception, e:
-        print e
-    finally:
-        # need to make sure we ack the messages so they don't get left un-acked
-        # in the queue we set multiple to true to ensure that we ack all
-        # previous messages
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag,
-                          multiple=True)
-    return
-
-
-def generate_queue_name():
-    """
-    generates a random queue name
-    """
-    return str(random.randint(0, 10000)) + "-" + str(random.randint(0, 100000))
+    if "application/protobuf" == content_type:
+        if routing_key == 'ingress.event.process':
+            (sensor, message)  = pbuf.protobuf_to_obj_and_host(body)
+            (hit,policy) = check_triggers(message)
+            if hit:
+              move_policy(sensor,policy)
+              print "ingress.event.process consume"
 
 
 def parse_config_file(filename):
@@ -134,7 +220,8 @@ def parse_config_file(filename):
     NOTE: note the conversion to unicode
     """
 
-    triggers={}
+    # sections are checked in the order they appear in the file
+    triggers=OrderedDict()
     parser = SafeConfigParser()
     parser.read(filename)
 
@@ -143,10 +230,8 @@ def parse_config_file(filename):
         triggers[s]={}
         triggers[s]['rules']=[]
         for o in parser.options(s):
-          stuff = o.lstrip("regex_")
-          if stuff != o:
-            triggers[s]['rules'].append(stuff)
-            triggers[s]['rules'].append(unicode(parser.get(s,o), "utf-8"))
+          if o.startswith("regex_"):
+            triggers[s]['rules'].append((o[len("regex_"):], unicode(parser.get(s,o), "utf-8")))
           else:
             triggers[s][o]=unicode(parser.get(s,o), "utf-8").strip("'")
 
@@ -156,7 +241,8 @@ def parse_config_file(filename):
             unicode(parser.get("settings", "cbtoken"), "utf-8"),
             unicode(parser.get("settings", "epserverip"), "utf-8"),
             unicode(parser.get("settings", "eptoken"), "utf-8"),
-            triggers)
+            triggers,
+            parser.getint("settings", "epcachettl") if parser.has_option("settings", "epcachettl") else 300)
 
 def Usage():
     return ("Usage: python move_policy_from_mbus.py <config file>")
@@ -175,51 +261,34 @@ if __name__ == "__main__":
     global eptoken
     global epserver
     global action_triggers
+    global policy_mover
     #
     # Parse the config file
     #
-    (username, password, cbserver, cbtoken, epserver, eptoken, action_triggers) = parse_config_file(configfile)
-
-    #
-    # Set the connection parameters to connect to to the rabbitmq:5004
-    # using the supplied username and password
-    #
-    credentials = pika.PlainCredentials(username,
-                                        password)
+    (username, password, cbserver, cbtoken, epserver, eptoken, triggers, epcachettl) = parse_config_file(configfile)
 
     #
-    # Create our parameters for pika
+    # Compile the trigger patterns once, rather than for every message
     #
-    parameters = pika.ConnectionParameters(cbserver,
-                                           5004,
-                                           '/',
-                                           credentials)
+    action_triggers = TriggerRules(triggers)
 
     #
-    # Create the connection
-    #
-    connection = pika.BlockingConnection(parameters)
-
+    # One Enterprise Protection API client for every move, caching the
+    # policies and computers it looks up
     #
-    # Get the channel from the connection
-    
-    channel = connection.channel()
+    bit9 = bit9api.bit9Api(
+        "https://"+epserver,  # Replace with actual Bit9 server URL
+        token=eptoken,
+        ssl_verify=False  # Don't validate server's SSL certificate. Set to True unless using self-signed cert on IIS
+    )
+    policy_mover = PolicyMover(bit9, ttl=epcachettl)
 
     #
-    # Create a random queue name
-    #
-    queue_name = generate_queue_name()
-
+    # Consume from the Carbon Black Server's rabbitmq:5004 using the supplied
+    # username and password; see mbus_helpers for the optional settings
     #
-    # make sure you use auto_delete so the queue isn't left filling
-    # with events when this program exists
-    channel.queue_declare(queue=queue_name, auto_delete=True)
-
-    #channel.queue_bind(exchange='api.events', queue=queue_name, routing_key='watchlist.hit.#')
-    channel.queue_bind(exchange='api.events', queue=queue_name, routing_key='ingress.event.process')
-
-
-    channel.basic_consume(on_message, queue=queue_name)
+    consumer = MessageBusConsumer(cbserver, username, password, ['ingress.event.process'], on_message,
+                                  **consumer_options(configfile))
 
     print
     print "Subscribed to events!"
@@ -227,9 +296,4 @@ if __name__ == "__main__":
            "to a more restricted Enterprise Protection Policy!")
     print
 
-    try:
-        channel.start_consuming()
-    except KeyboardInterrupt:
-        channel.stop_consuming()
-
-    connection.close()
+    consumer.run()
@@ -0,0 +1,235 @@
+#
+#The MIT License (MIT)
+#
+# Copyright (c) 2016 Carbon Black
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# -----------------------------------------------------------------------------
+#  Shared netconn decoding helpers
+#
+#  Process documents report each network connection as a single | delimited
+#  string in the netconn_complete list:
+#
+#    (TIME)|(IP)|(PORT)|(PROTOCOL)|(DOMAIN)|(DIRECTION)
+#    2013-02-08 14:44:06.000000|460258477|80|6|facebook.com|true
+#
+#  Splitting and converting these one string at a time dominates the run time
+#  of the network scripts for busy processes.  decode_netconns() instead decodes
+#  a whole netconn_complete list in a single pass into a numpy structured
+#  array, so that subnet, port and direction filters can run as array masks.
+#
+#  Requires numpy.
+#
+
+import socket
+import struct
+
+import numpy
+
+NETCONN_DTYPE = numpy.dtype([
+    ("timestamp", "S32"),     # timestamp string, as reported by the server
+    ("ip", numpy.uint32),     # remote IPv4 address; 0 when not known (e.g. web proxy)
+    ("port", numpy.int32),    # remote port for outbound, local port for inbound
+    ("proto", numpy.uint8),   # IP protocol number (6 = tcp, 17 = udp)
+    ("outbound", numpy.bool_),
+    ("domain_id", numpy.int32),  # index into the domain list returned alongside
+])
+
+PROTOCOL_NAMES = {6: "tcp", 17: "udp"}
+
+
+def decode_netconns(netconns):
+    """
+    decode a netconn_complete list into a (netconns, domains) tuple
+
+    netconns is a numpy structured array of NETCONN_DTYPE, one row per
+    well-formed netconn event, in the original order.  domains is the list
+    of distinct domain names; each row's domain_id indexes into it, and
+    connections without a domain refer to the empty string.
+
+    events that do not have exactly six fields, or whose ip, port or
+    protocol is not a number, are skipped.
+    """
+    # events without six fields are dropped up front, since a short event
+    # next to a long one would shift every column after them
+    if any(netconn.count("|") != 5 for netconn in netconns):
+        netconns = [netconn for netconn in netconns if netconn.count("|") == 5]
+
+    try:
+        return _decode_fields(netconns)
+    except ValueError:
+        # some event has an ip, port or protocol that is not a number; find
+        # and drop the bad events one at a time, rather than the whole list
+        return _decode_fields([netconn for netconn in netconns if _is_well_formed(netconn)])
+
+
+def _is_well_formed(netconn):
+    fields = netconn.split("|")
+    try:
+        int(fields[1] or "0"), int(fields[2]), int(fields[3])
+    except ValueError:
+        return False
+    return True
+
+
+def _decode_fields(netconns):
+    if not netconns:
+        return numpy.zeros(0, dtype=NETCONN_DTYPE), []
+
+    # split every event with a single join and split, rather than one
+    # split per event; every event has six fields by now
+    fields = "|".join(netconns).split("|")
+
+    decoded = numpy.zeros(len(netconns), dtype=NETCONN_DTYPE)
+    decoded["timestamp"] = fields[0::6]
+
+    # the server reports the ip as a signed 32 bit integer in network order;
+    # the ip is the empty string when the sensor could not see it
+    ips = numpy.array([ip or "0" for ip in fields[1::6]], dtype=numpy.int64)
+    decoded["ip"] = ips & 0xffffffff
+
+    decoded["port"] = numpy.array(fields[2::6], dtype=numpy.int32)
+    decoded["proto"] = numpy.array(fields[3::6], dtype=numpy.uint8)
+
+    # older servers report the direction as "1"/"0" rather than "true"/"false"
+    directions = numpy.array(fields[5::6])
+    decoded["outbound"] = (directions == "true") | (directions == "1")
+
+    # intern the domain names; most processes talk to a handful of domains
+    domains, domain_ids = numpy.unique(numpy.array(fields[4::6]), return_inverse=True)
+    decoded["domain_id"] = domain_ids
+
+    return decoded, domains.tolist()
+
+
+def ip_to_int(ip):
+    """
+    convert a dotted-quad string IP to the unsigned int used in decoded netconns
+    """
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+def int_to_ip(ip):
+    """
+    convert an unsigned int IP from a decoded netconn to a dotted-quad string
+    """
+    return socket.inet_ntoa(struct.pack("!I", int(ip)))
+
+
+def protocol_name(proto):
+    """
+    return the human-readable name (tcp or udp) of an IP protocol number
+    """
+    return PROTOCOL_NAMES.get(int(proto), str(proto))
+
+
+def cidr_to_range(cidr):
+    """
+    return the (first, last) unsigned int IPs of a subnet given in CIDR
+    notation, e.g. 192.168.1.0/24
+    """
+    net, bits = cidr.split("/")
+    netmask = (0xffffffff << (32 - int(bits))) & 0xffffffff
+    first = ip_to_int(net) & netmask
+    return first, first | (~netmask & 0xffffffff)
+
+
+def range_to_cidrs(first, last):
+    """
+    return the shortest list of CIDR subnets that exactly covers the
+    unsigned int IP range first..last (inclusive)
+    """
+    cidrs = []
+    while first <= last:
+        # the largest block that starts at first (it must be aligned on its
+        # own size) and does not extend beyond last
+        bits = 32
+        while bits > 0:
+            size = 1 << (33 - bits)
+            if first % size != 0 or first + size - 1 > last:
+                break
+            bits = bits - 1
+        cidrs.append("%s/%d" % (int_to_ip(first), bits))
+        first = first + (1 << (32 - bits))
+    return cidrs
+
+
+class SubnetIndex(object):
+    """
+    sorted index of the IPv4 address ranges covered by a list of CIDR
+    subnets.  overlapping and adjacent subnets are merged when the index
+    is built, so each ip can be tested against every subnet with a single
+    binary search
+    """
+    def __init__(self, cidrs):
+        merged = []
+        for first, last in sorted(cidr_to_range(cidr) for cidr in cidrs):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+
+        self.ranges = [tuple(r) for r in merged]
+        self.firsts = numpy.array([r[0] for r in merged], dtype=numpy.uint32)
+        self.lasts = numpy.array([r[1] for r in merged], dtype=numpy.uint32)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def cidrs(self):
+        """
+        return the shortest list of CIDR subnets covering the index; this is
+        the union of the subnets the index was built from
+        """
+        cidrs = []
+        for first, last in self.ranges:
+            cidrs.extend(range_to_cidrs(first, last))
+        return cidrs
+
+    def mask(self, netconns):
+        """
+        return a boolean mask of the decoded netconns whose ip falls within
+        any of the indexed subnets.  netconns without a known ip never match
+        """
+        ips = netconns["ip"]
+        if len(self.ranges) == 0:
+            return numpy.zeros(len(ips), dtype=numpy.bool_)
+
+        # the candidate range for each ip is the last one starting at or
+        # before it; the ip matches if that range has not ended before it
+        candidates = numpy.searchsorted(self.firsts, ips, side="right") - 1
+        matched = ips <= self.lasts[numpy.maximum(candidates, 0)]
+        return matched & (candidates >= 0) & (ips != 0)
+
+
+def ip_mask(netconns, ip):
+    """
+    return a boolean mask of the decoded netconns made to the dotted-quad ip
+    """
+    return netconns["ip"] == ip_to_int(ip)
+
+
+def domain_mask(netconns, domains, substring):
+    """
+    return a boolean mask of the decoded netconns whose domain contains the
+    given substring.  the substring test runs once per distinct domain
+    """
+    matching_ids = [i for i, domain in enumerate(domains) if substring in domain]
+    return numpy.in1d(netconns["domain_id"], matching_ids)
@@ -34,14 +34,26 @@
 import sys
 import struct
 import socket
+import threading
+import Queue
 from optparse import OptionParser
 
 from cbapi import CbApi
 
+import netconn_helpers
+
 class CBQuery(object):
-    def __init__(self, url, token, ssl_verify):
+    def __init__(self, url, token, ssl_verify, page_size=100, workers=8):
         self.cb = CbApi(url, token=token, ssl_verify=ssl_verify)
         self.cb_url = url
+        self.page_size = page_size
+        self.workers = workers
+
+        # bounds the number of search results that have been paged in
+        # but not yet written out, so a slow writer cannot cause the
+        # pager to buffer the entire result set in memory
+        self.inflight = threading.BoundedSemaphore(workers * 4)
+        self.pager_error = None
 
         # set up some stat tracking
         self.stats = {}
@@ -57,9 +69,9 @@ class CBQuery(object):
         """
         return self.stats
 
-    def outputNetConn(self, proc, netconn):
+    def outputNetConn(self, proc, netconn, domains):
         """
-        output a single netconn event from a process document
+        output a single decoded netconn event from a process document
         the caller is responsible for ensuring that the document
         meets start time and subnet criteria
         """
@@ -74,59 +86,91 @@ class CBQuery(object):
         procstarttime = proc.get("start", "<unknown>")
         proclastupdate = proc.get("last_update", "<unknown>")
 
-        # split the netconn into component parts
-        ts, ip, port, proto, domain, dir = netconn.split("|")
-
         # get the dotted-quad string representation of the ip
-        str_ip = socket.inet_ntoa(struct.pack("!i", int(ip)))
+        str_ip = netconn_helpers.int_to_ip(netconn["ip"])
                     
         # the underlying data model provides the protocol number
         # convert this to human-readable strings (tcp or udp)
-        if "6" == proto:
-            proto = "tcp"
-        elif "17" == proto:
-            proto = "udp"
+        proto = netconn_helpers.protocol_name(netconn["proto"])
                   
         # the underlying data model provides a boolean indication as to
         # if this is an inbound or outbound network connection 
-        if "true" == dir:
+        if netconn["outbound"]:
             dir = "out"
         else:
            dir = "in" 
 
         # print the record, using pipes as a delimiter
-        print "%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|" % (procstarttime,proclastupdate,hostname, user_name, proto, str_ip, port, dir, domain, process_name, process_md5, path, cmdline)
-
-    def addressInNetwork(self, ip, cidr):
-
-        # the ip can be the emtpy string ('') in cases where the connection
-        # is made via a web proxy.  in these cases the sensor cannot report
-        # the true remote IP as DNS resolution happens on the web proxy (and
-        # not the endpoint)
-        if '' == ip:
-            return False
+        print "%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|" % (procstarttime,proclastupdate,hostname, user_name, proto, str_ip, netconn["port"], dir, domains[netconn["domain_id"]], process_name, process_md5, path, cmdline)
 
+    def page_results(self, queries, work_queue):
+        """
+        pager stage; walk the result set of each query one page at a time,
+        queueing each result (with its sequence number) for the workers.
+        a process segment matched by more than one query is only queued once
+        """
+        seen = set()
+        seq = 0
         try:
-            net = cidr.split('/')[0]
-            bits = cidr.split('/')[1]
-
-            if int(ip) > 0: 
-                ipaddr = struct.unpack('<L', socket.inet_aton(ip))[0]
-            else:
-                ipaddr = struct.unpack('<L', socket.inet_aton(".".join(map(lambda n: str(int(ip)>>n & 0xFF), [24,16,8,0]))))[0]
-            netaddr = struct.unpack('<L', socket.inet_aton(net))[0]
-            netmask = ((1L << int(bits)) - 1)
-                
-            return ipaddr & netmask == netaddr & netmask
-
-        except:
-            return False
-
-    def report(self, result, subnet):
+            for q in queries:
+                start = 0
+                while True:
+
+                    # get the next page of results
+                    procs = self.cb.process_search(q, start=start, rows=self.page_size)
+
+                    # if there are no results, we are done paging
+                    if len(procs["results"]) == 0:
+                        break
+
+                    for result in procs["results"]:
+                        key = (result["id"], result["segment_id"])
+                        if key in seen:
+                            continue
+                        seen.add(key)
+
+                        # track the total number of matching results
+                        self.stats['total_processes'] = len(seen)
+
+                        self.inflight.acquire()
+                        work_queue.put((seq, result))
+                        seq = seq + 1
+
+                    # move forward to the next page
+                    start = start + self.page_size
+        except Exception, e:
+            self.pager_error = e
+        finally:
+            # one stop marker per worker
+            for i in range(self.workers):
+                work_queue.put(None)
+
+    def fetch_events(self, work_queue, result_queue):
+        """
+        worker stage; fetch the events document for each queued search
+        result and hand it on to the writer
+        """
+        while True:
+            item = work_queue.get()
+            if item is None:
+                result_queue.put(None)
+                return
+
+            seq, result = item
+            try:
+                # return the events associated with this process segment
+                # this will include netconns, as well as modloads, filemods, etc.
+                events = self.cb.process_events(result["id"], result["segment_id"])
+                result_queue.put((seq, result, events, None))
+            except Exception, e:
+                result_queue.put((seq, result, None, e))
+
+    def report(self, result, subnets, events=None):
 
         # return the events associated with this process segment
         # this will include netconns, as well as modloads, filemods, etc.
-        events = self.cb.process_events(result["id"], result["segment_id"])
+        if events is None:
+            events = self.cb.process_events(result["id"], result["segment_id"])
         
         proc = events["process"]
 
@@ -134,25 +178,26 @@ class CBQuery(object):
         # all results have at least one netconn
         if proc.has_key("netconn_complete"):
 
-            # examine each netconn in turn
-            for netconn in proc["netconn_complete"]:
-        
-                # update the count of total netconns
-                self.stats['total_netconns'] = self.stats['total_netconns'] + 1
-        
-                # split the netconn event into component parts
-                # note that the port is the remote port in the case of outbound
-                # netconns, and local port in the case of inbound netconns
-                #
-                # for the purpose of this example script, eat any errors
-                ts, ip, port, proto, domain, dir = netconn.split("|")
-                if self.addressInNetwork(ip, subnet): 
-                    try:
-                        self.stats['matching_netconns'] = self.stats['matching_netconns'] + 1
-                        self.outputNetConn(proc, netconn)
-                    except:
-                        self.stats['output_errors'] = self.stats['output_errors'] + 1
-                        pass 
+            # decode all of the netconn events in one pass, then select
+            # the ones in any of the subnets with a single array mask
+            #
+            # note that the ip can be unknown in cases where the connection
+            # is made via a web proxy.  in these cases the sensor cannot report
+            # the true remote IP as DNS resolution happens on the web proxy (and
+            # not the endpoint), and the netconn never matches
+            netconns, domains = netconn_helpers.decode_netconns(proc["netconn_complete"])
+
+            # update the count of total netconns
+            self.stats['total_netconns'] = self.stats['total_netconns'] + len(netconns)
+
+            # for the purpose of this example script, eat any errors
+            for netconn in netconns[subnets.mask(netconns)]:
+                try:
+                    self.stats['matching_netconns'] = self.stats['matching_netconns'] + 1
+                    self.outputNetConn(proc, netconn, domains)
+                except:
+                    self.stats['output_errors'] = self.stats['output_errors'] + 1
+                    pass 
 
     def strip_to_int(ip):
         """
@@ -160,49 +205,78 @@ class CBQuery(object):
         """
         return struct.unpack('<L', socket.inet_aton(ip))[0]
 
-    def check(self, subnet, datetype, begin, end):
+    def check(self, subnets, datetype, begin, end, query_batch_size=100):
 
         # print a legend
         print "%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|" % ("ProcStartTime", "ProcUpdateTime","hostname", "username", "protocol", "ip", "port", "direction", "domain",  "process name",  "process md5", "process path", "cmdline")
 
-        # build the query string
-        if not end and not begin:
-            q = "ipaddr:%s" % (subnet,) 
-        else:
-            if not end: end = "*"
-            if not begin: begin = "*"
-            q = "ipaddr:%s %s:[%s TO %s]" % (subnet, datetype, begin, end)
-
-        # begin with the first result - we'll perform the search in pages 
-        # the default page size is 10 (10 results)
-        start = 0
-
-        # loop over the entire result set, paging as required
-        while True:
-
-            # get the next page of results 
-            procs = self.cb.process_search(q, start=start)
-            
-            # track the total number of matching results
-            self.stats['total_processes'] = procs['total_results']
-
-            # if there are no results, we are done paging 
-            if len(procs["results"]) == 0:
-                break
-
-            # examine each result individually
-            # each result represents a single segment of a single process
-            #
-            # for the purposes of this example script, eat any errors
-            #
-            for result in procs["results"]:
+        # index the subnets once; overlapping and adjacent subnets are merged
+        # so the server is only asked for the union of the ranges
+        subnets = netconn_helpers.SubnetIndex(subnets)
+        cidrs = subnets.cidrs()
+
+        # build the query strings, ORing together up to query_batch_size
+        # subnets in each
+        queries = []
+        for i in xrange(0, len(cidrs), query_batch_size):
+            q = " OR ".join(["ipaddr:%s" % (cidr,) for cidr in cidrs[i:i + query_batch_size]])
+            if not end and not begin:
+                q = "(%s)" % (q,)
+            else:
+                if not end: end = "*"
+                if not begin: begin = "*"
+                q = "(%s) %s:[%s TO %s]" % (q, datetype, begin, end)
+            queries.append(q)
+
+        # the search is performed in pages by a pager thread, the events
+        # for each result are fetched concurrently by a pool of workers,
+        # and the rows are written here, in search result order
+        work_queue = Queue.Queue()
+        result_queue = Queue.Queue()
+
+        threads = [threading.Thread(target=self.page_results, args=(queries, work_queue))]
+        for i in range(self.workers):
+            threads.append(threading.Thread(target=self.fetch_events, args=(work_queue, result_queue)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # results arrive from the workers out of order; hold on to them
+        # until every earlier result has been written
+        pending = {}
+        next_seq = 0
+        running = self.workers
+        while running:
+            try:
+                item = result_queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+
+            if item is None:
+                running = running - 1
+                continue
+
+            pending[item[0]] = item
+            while next_seq in pending:
+                seq, result, events, error = pending.pop(next_seq)
+
+                # examine each result individually
+                # each result represents a single segment of a single process
+                #
+                # for the purposes of this example script, eat any errors
+                #
                 try:
-                    self.report(result, subnet)
+                    if error is not None:
+                        raise error
+                    self.report(result, subnets, events)
                 except Exception, e:
                     self.stats['process_errors'] = self.stats['process_errors'] + 1
 
-            # move forward to the next page 
-            start = start + 10
+                self.inflight.release()
+                next_seq = next_seq + 1
+
+        if self.pager_error is not None:
+            raise self.pager_error
 
 def is_valid_cidr(subnet):
     """
@@ -214,12 +288,12 @@ def is_valid_cidr(subnet):
             return False
         ip = socket.inet_aton(components[0])
         mask = int(components[1])
-        return True
+        return 0 <= mask <= 32
     except:
         return False 
 
 def build_cli_parser():
-    parser = OptionParser(usage="%prog [options]", description="Dump all network traffic for a specific subnet with optional date range")
+    parser = OptionParser(usage="%prog [options]", description="Dump all network traffic for one or more subnets with optional date range")
 
     # for each supported output type, add an option
     parser.add_option("-c", "--cburl", action="store", default=None, dest="url",
@@ -232,18 +306,26 @@ def build_cli_parser():
                       help="Output stats at end of run.")
     parser.add_option("-s", "--subnet", action="store", default=None, dest="subnet",
                       help="Subnet, as specified in CIDR notation e.g. 127.0.0.1/32, to query for network traffic")
+    parser.add_option("-f", "--subnet-file", action="store", default=None, dest="subnet_file",
+                      help="File of newline delimited subnets, in CIDR notation, to query for network traffic")
+    parser.add_option("-q", "--query-batch-size", action="store", default=100, dest="query_batch_size", type="int",
+                      help="Number of subnets to OR together in each search query")
     parser.add_option("-b", "--begin", action="store", default=None, dest="begin",
                       help="Beginning date to start from Format: YYYY-MM-DD")
     parser.add_option("-e", "--end", action="store", default=None, dest="end",
                       help="Beginning date to start from Format: YYYY-MM-DD")                      
     parser.add_option("-t", "--datetype", action="store", default=None, dest="datetype",
                       help="Either Start time or Last Update Time [start|last_update]")                              
+    parser.add_option("-p", "--pagesize", action="store", default=100, dest="pagesize", type="int",
+                      help="Number of processes to retrieve during each search API invocation")
+    parser.add_option("-w", "--workers", action="store", default=8, dest="workers", type="int",
+                      help="Number of threads fetching process events concurrently")
     return parser
 
 def main(argv):
     parser = build_cli_parser()
     opts, args = parser.parse_args(argv)
-    if not opts.url or not opts.token or not opts.subnet :
+    if not opts.url or not opts.token or not (opts.subnet or opts.subnet_file):
         print "Missing required param."
         sys.exit(-1)
     if (opts.begin or opts.end ) and not opts.datetype:
@@ -252,13 +334,34 @@ def main(argv):
     if opts.datetype and (opts.datetype != "start" and opts.datetype != "last_update"):
         print "The date type has to be one of 'start' or 'last_update'"
         sys.exit(-1)
-    if not is_valid_cidr(opts.subnet):
-        print "The subnet must be in CIDR notation e.g. 192.168.1.0/24"
-        sys.exit(-1) 
 
-    cb = CBQuery(opts.url, opts.token, ssl_verify=opts.ssl_verify)
+    subnets = []
+    if opts.subnet:
+        subnets.append(opts.subnet)
+    if opts.subnet_file:
+        for line in open(opts.subnet_file, "r"):
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            subnets.append(line)
+
+    for subnet in subnets:
+        if not is_valid_cidr(subnet):
+            print "The subnet must be in CIDR notation e.g. 192.168.1.0/24 (got %s)" % (subnet,)
+            sys.exit(-1) 
+
+    if opts.query_batch_size < 1:
+        print "The query batch size must be at least 1"
+        sys.exit(-1)
+
+    if opts.pagesize < 1 or opts.workers < 1:
+        print "The page size and number of workers must be at least 1"
+        sys.exit(-1)
+
+    cb = CBQuery(opts.url, opts.token, ssl_verify=opts.ssl_verify,
+                 page_size=opts.pagesize, workers=opts.workers)
 
-    cb.check(opts.subnet, opts.datetype, opts.begin, opts.end)
+    cb.check(subnets, opts.datetype, opts.begin, opts.end, opts.query_batch_size)
 
     stats = cb.getStats()
 
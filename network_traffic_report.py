@@ -32,21 +32,83 @@
 
 # in the github repo, cbapi is not in the example directory
 import sys
-import struct
-import socket
+import threading
+import Queue
 from optparse import OptionParser
 from cbapi import CbApi
 
+import netconn_helpers
+
 class CBQuery(object):
-    def __init__(self, url, token, ssl_verify):
+    def __init__(self, url, token, ssl_verify, page_size=100, workers=8):
         self.cb = CbApi(url, token=token, ssl_verify=ssl_verify)
         self.cb_url = url
-
-    def report(self, hostname, result):
+        self.page_size = page_size
+        self.workers = workers
+
+        # bounds the number of search results that have been paged in
+        # but not yet written out, so a slow writer cannot cause the
+        # pager to buffer the entire result set in memory
+        self.inflight = threading.BoundedSemaphore(workers * 4)
+        self.pager_error = None
+
+    def page_results(self, q, work_queue):
+        """
+        pager stage; walk the search result set one page at a time,
+        queueing each result (with its sequence number) for the workers
+        """
+        start = 0
+        seq = 0
+        try:
+            while True:
+
+                # get the next page of results
+                procs = self.cb.process_search(q, start=start, rows=self.page_size)
+
+                # if there are no results, we are done paging
+                if len(procs["results"]) == 0:
+                    break
+
+                for result in procs["results"]:
+                    self.inflight.acquire()
+                    work_queue.put((seq, result))
+                    seq = seq + 1
+
+                # move forward to the next page
+                start = start + self.page_size
+        except Exception, e:
+            self.pager_error = e
+        finally:
+            # one stop marker per worker
+            for i in range(self.workers):
+                work_queue.put(None)
+
+    def fetch_events(self, work_queue, result_queue):
+        """
+        worker stage; fetch the events document for each queued search
+        result and hand it on to the writer
+        """
+        while True:
+            item = work_queue.get()
+            if item is None:
+                result_queue.put(None)
+                return
+
+            seq, result = item
+            try:
+                # return the events associated with this process segment
+                # this will include netconns, as well as modloads, filemods, etc.
+                events = self.cb.process_events(result["id"], result["segment_id"])
+                result_queue.put((seq, result, events, None))
+            except Exception, e:
+                result_queue.put((seq, result, None, e))
+
+    def report(self, hostname, result, events=None):
         
         # return the events associated with this process segment
         # this will include netconns, as well as modloads, filemods, etc.
-        events = self.cb.process_events(result["id"], result["segment_id"])
+        if events is None:
+            events = self.cb.process_events(result["id"], result["segment_id"])
         
         proc = events["process"]
 
@@ -59,33 +121,30 @@ class CBQuery(object):
         # all results have at least one netconn
         if proc.has_key("netconn_complete"):
 
+            # decode all of the netconn events in one pass
+            # note that the port is the remote port in the case of outbound
+            # netconns, and local port in the case of inbound netconns
+            netconns, domains = netconn_helpers.decode_netconns(proc["netconn_complete"])
+
             # examine each netconn in turn
-            for netconn in proc["netconn_complete"]:
+            for netconn in netconns:
 
-                # split the netconn event into component parts
-                # note that the port is the remote port in the case of outbound
-                # netconns, and local port in the case of inbound netconns
-                ts, ip, port, proto, domain, dir = netconn.split("|")
-                
                 # get the dotted-quad string representation of the ip
-                str_ip = socket.inet_ntoa(struct.pack("!i", int(ip)))
+                str_ip = netconn_helpers.int_to_ip(netconn["ip"])
                 
                 # the underlying data model provides the protocol number
                 # convert this to human-readable strings (tcp or udp)
-                if "6" == proto:
-                    proto = "tcp"
-                elif "17" == proto:
-                    proto = "udp"
+                proto = netconn_helpers.protocol_name(netconn["proto"])
                
                 # the underlying data model provides a boolean indication as to
                 # if this is an inbound or outbound network connection 
-                if "true" == dir:
+                if netconn["outbound"]:
                     dir = "out"
                 else:
                     dir = "in" 
 
                 # pring the record, using pipes as a delimiter
-                print "%s|%s|%s|%s|%s|%s|%s|%s|%s|%s)" % (hostname, ts, process_name, user_name, process_md5, proto, str_ip, port, dir, domain)
+                print "%s|%s|%s|%s|%s|%s|%s|%s|%s|%s)" % (hostname, netconn["timestamp"], process_name, user_name, process_md5, proto, str_ip, netconn["port"], dir, domains[netconn["domain_id"]])
 
     def check(self, hostname):
 
@@ -95,27 +154,45 @@ class CBQuery(object):
         # build the query string
         q = "netconn_count:[1 to *] AND hostname:%s" % (hostname)
       
-        # begin with the first result - we'll perform the search in pages 
-        # the default page size is 10 (10 reslts)
-        start = 0
-
-        # loop over the entire result set
-        while True:
-
-            # get the next page of results 
-            procs = self.cb.process_search(q, start=start)
-      
-            # if there are no results, we are done paging 
-            if len(procs["results"]) == 0:
-                break
-
-            # examine each result individually
-            # each result represents a single process segment
-            for result in procs["results"]:
-                self.report(hostname, result)
-
-            # move forward to the next page 
-            start = start + 10
+        # the search is performed in pages by a pager thread, the events
+        # for each result are fetched concurrently by a pool of workers,
+        # and the rows are written here, in search result order
+        work_queue = Queue.Queue()
+        result_queue = Queue.Queue()
+
+        threads = [threading.Thread(target=self.page_results, args=(q, work_queue))]
+        for i in range(self.workers):
+            threads.append(threading.Thread(target=self.fetch_events, args=(work_queue, result_queue)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # results arrive from the workers out of order; hold on to them
+        # until every earlier result has been written
+        pending = {}
+        next_seq = 0
+        running = self.workers
+        while running:
+            try:
+                item = result_queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+
+            if item is None:
+                running = running - 1
+                continue
+
+            pending[item[0]] = item
+            while next_seq in pending:
+                seq, result, events, error = pending.pop(next_seq)
+                if error is not None:
+                    raise error
+                self.report(hostname, result, events)
+                self.inflight.release()
+                next_seq = next_seq + 1
+
+        if self.pager_error is not None:
+            raise self.pager_error
 
 
 def build_cli_parser():
@@ -130,6 +207,10 @@ def build_cli_parser():
                       help="Do not verify server SSL certificate.")
     parser.add_option("-H", "--hostname", action="store", default=None, dest="hostname",
                       help="Endpoint hostname to query for network traffic")
+    parser.add_option("-p", "--pagesize", action="store", default=100, dest="pagesize", type="int",
+                      help="Number of processes to retrieve during each search API invocation")
+    parser.add_option("-w", "--workers", action="store", default=8, dest="workers", type="int",
+                      help="Number of threads fetching process events concurrently")
     return parser
 
 def main(argv):
@@ -139,7 +220,12 @@ def main(argv):
         print "Missing required param."
         sys.exit(-1)
 
-    cb = CBQuery(opts.url, opts.token, ssl_verify=opts.ssl_verify)
+    if opts.pagesize < 1 or opts.workers < 1:
+        print "The page size and number of workers must be at least 1"
+        sys.exit(-1)
+
+    cb = CBQuery(opts.url, opts.token, ssl_verify=opts.ssl_verify,
+                 page_size=opts.pagesize, workers=opts.workers)
 
     cb.check(opts.hostname)
 
@@ -29,6 +29,7 @@
 #    python process_cmdline_regex.py -c https://127.0.0.1:443 -a 6b5aee99c133c003b9c11e584c9958da8f8943fa -n -r .*\\.dll -C -M
 #    python process_cmdline_regex.py -c https://127.0.0.1:443 -a 6b5aee99c133c003b9c11e584c9958da8f8943fa -n -r \\.dll -C
 #    python process_cmdline_regex.py -c https://127.0.0.1:443 -a 6b5aee99c133c003b9c11e584c9958da8f8943fa -n -r "(rundll.*\\.dll)" -G 0
+#    python process_cmdline_regex.py -c https://127.0.0.1:443 -a 6b5aee99c133c003b9c11e584c9958da8f8943fa -n -r "(rundll.*\\.dll)" -G 0 -w 16
 #
 # EXAMPLE OUTPUT:
 #
@@ -77,17 +78,202 @@
 
 import sys
 import re
+import sre_parse
+import sre_constants
 import struct
 import socket
+import signal
 import collections
+import multiprocessing
 import operator
 from optparse import OptionParser
 from cbapi import CbApi
 
+from checkpoint_helpers import Checkpoint
+from counter_helpers import SpaceSavingCounter
+
+def required_literals(regex):
+    """
+    return the literal strings that every match of the regex must contain,
+    e.g. ["rundll", ".dll"] for rundll.*\.dll.  only literals outside of
+    alternations and optional or repeated-zero-or-more groups are required.
+    non-ASCII characters end a literal
+    """
+    literals = []
+    collect_required_literals(sre_parse.parse(regex), literals)
+    return literals
+
+def collect_required_literals(subpattern, literals):
+    run = []
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL and av < 128:
+            run.append(chr(av))
+            continue
+
+        # anything else ends the current run of literal characters
+        if run:
+            literals.append("".join(run))
+            run = []
+
+        # the contents of a group, and of a repetition that must occur
+        # at least once, are themselves required
+        if op == sre_constants.SUBPATTERN:
+            collect_required_literals(av[-1], literals)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            collect_required_literals(av[2], literals)
+
+    if run:
+        literals.append("".join(run))
+
+def build_query(regexes, max_terms=3):
+    """
+    build a cmdline query that narrows the search to processes whose
+    command line could match at least one of the regexes
+
+    the server tokenizes command lines on whitespace and punctuation, so
+    each required literal is broken into its runs of letters and of digits,
+    and each run (of three or more characters) is searched for as part of
+    a token.  the longest max_terms runs of each regex are ANDed together,
+    and the regexes are ORed.  if any regex has no usable literal, every
+    command line must be scanned (cmdline:*)
+    """
+    clauses = []
+    for regex in regexes:
+        tokens = []
+        for literal in required_literals(regex):
+            for token in re.findall("[a-z]+|[0-9]+", literal.lower()):
+                if len(token) >= 3 and token not in tokens:
+                    tokens.append(token)
+        if not tokens:
+            return "cmdline:*"
+
+        tokens = sorted(tokens, key=len, reverse=True)[:max_terms]
+        clauses.append("(%s)" % (" AND ".join(["cmdline:*%s*" % (token,) for token in tokens]),))
+
+    return " OR ".join(clauses)
+
+# a backreference or conditional group refers to groups by number (or name),
+# which changes meaning once the pattern is embedded in a combined regex
+GROUP_REFERENCE_REGEX = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+class CmdlineMatcher(object):
+    """
+    Evaluates one or more regular expressions against batches of command
+    lines, in a single pass.  When running with more than one worker, each
+    worker process builds its own matcher (see init_worker) so the regexes
+    are compiled once per process rather than once per batch.
+    """
+    def __init__(self, regexes, ignore_case, group_reference_to_match, matches_only_flag):
+        # check if we need to ignore case, if so, update regexp
+        if ignore_case:
+            flags = re.IGNORECASE
+        else:
+            flags = 0
+        self.regexps = [re.compile(regex, flags) for regex in regexes]
+
+        # a regex can only match a command line that contains all of its
+        # required literals.  the literals are tested case-insensitively,
+        # against a lowercased copy of the command line, which is a cheap
+        # way to skip most of the regexes for most command lines
+        self.literals = [[literal.lower() for literal in required_literals(regex)] for regex in regexes]
+
+        # match MUST begin at the 1st character of the command line, or anywhere
+        self.matches_only_flag = matches_only_flag
+
+        # with several regexes, most command lines match none of them.  a
+        # single alternation of all of them rejects those command lines in one
+        # regex evaluation; only command lines it accepts are tried against
+        # each regex in turn.  this is not safe if any regex refers to its
+        # own groups, or if the regexes cannot be combined (e.g. they share
+        # a group name).  a regex with inline flags such as (?x) or (?i) is
+        # left out of the alternation, since its flags would apply to all the
+        # others, and is always tried on its own
+        self.combined = None
+        self.uncombined = range(len(regexes))
+        if not any(GROUP_REFERENCE_REGEX.search(regex) for regex in regexes):
+            combinable = [index for index, regex in enumerate(regexes) if not sre_parse.parse(regex).pattern.flags]
+            if len(combinable) > 1:
+                try:
+                    self.combined = re.compile("|".join(["(?:%s)" % (regexes[index],) for index in combinable]),
+                                               flags)
+                    self.uncombined = [index for index in range(len(regexes)) if index not in combinable]
+                except re.error:
+                    self.combined = None
+
+        if group_reference_to_match:
+            self.group = int(group_reference_to_match)
+        else:
+            self.group = None
+
+    def find(self, regexp, cmdline):
+        if self.matches_only_flag:
+            return regexp.match(cmdline)
+        return regexp.search(cmdline)
+
+    def match_batch(self, cmdlines):
+        """
+        return a (regex index, dictionary key) tuple for each regex matching
+        each command line, in order.  the key is either the entire command
+        line or the requested reference group; a regex with fewer groups
+        than the requested reference group uses the entire command line
+        """
+        keys = []
+        for cmdline in cmdlines:
+            if self.combined is not None and self.find(self.combined, cmdline) is None:
+                indexes = self.uncombined
+                if not indexes:
+                    continue
+            else:
+                indexes = range(len(self.regexps))
+
+            lowered_cmdline = cmdline.lower()
+            for index in indexes:
+                regexp = self.regexps[index]
+                if not all(literal in lowered_cmdline for literal in self.literals[index]):
+                    continue
+                search_match_result = self.find(regexp, cmdline)
+                if search_match_result is None:
+                    continue
+                if self.group is not None and self.group <= regexp.groups:
+                    keys.append((index, search_match_result.group(self.group)))
+                else:
+                    keys.append((index, cmdline))
+        return keys
+
+# the matcher owned by each pool worker process
+worker_matcher = None
+
+def init_worker(regexes, ignore_case, group_reference_to_match, matches_only_flag):
+    global worker_matcher
+
+    # leave Ctrl-C handling to the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_matcher = CmdlineMatcher(regexes, ignore_case, group_reference_to_match, matches_only_flag)
+
+def match_batch(cmdlines):
+    return worker_matcher.match_batch(cmdlines)
+
 class CBQuery(object):
-    def __init__(self, url, token, ssl_verify):
+    def __init__(self, url, token, ssl_verify, page_size=100, batch_size=1000, workers=1, checkpoint=None,
+                 max_entries=None, top=None):
         self.cb = CbApi(url, token=token, ssl_verify=ssl_verify)
         self.cb_url = url
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+
+        # with max_entries, each match dictionary keeps at most that many
+        # distinct matches, and counts become approximate (see counter_helpers)
+        self.max_entries = max_entries
+        self.top = top
+
+        # the number of search results whose matches have been merged
+        self.cursor = 0
+
+        # one match dictionary and match count per regex
+        self.regex_match_dictionaries = []
+        self.search_match_counts = []
 
     def report(self, rundll_query, dll_dictionary, search_match_count):
 	    # CALLED BY: self.report(regex, regex_match_dictionary, search_match_count)
@@ -98,76 +284,167 @@ class CBQuery(object):
         print "--------------------------------------------"
  
 	    #ordered_dll_dictionary = collections.OrderedDict(sorted(dll_dictionary.items()))
-        ordered_dll_dictionary = sorted(dll_dictionary.items(), key=operator.itemgetter(1))
-        for value in ordered_dll_dictionary:
-            print "%s : %s" % (value[1], value[0])
+        if self.top:
+            # the top N matches, still in ascending order of count; a match
+            # that is not certain to be in the true top N is marked with a *
+            ordered_dll_dictionary = reversed(dll_dictionary.top(self.top))
+            for key, count, guaranteed in ordered_dll_dictionary:
+                if guaranteed:
+                    print "%s : %s" % (count, key)
+                else:
+                    print "%s* : %s" % (count, key)
+        else:
+            ordered_dll_dictionary = sorted(dll_dictionary.items(), key=operator.itemgetter(1))
+            for value in ordered_dll_dictionary:
+                print "%s : %s" % (value[1], value[0])
+
+        if dll_dictionary.max_error() > 0:
+            print "--------------------------------------------"
+            print "NOTE: only the %d most frequent matches were kept; counts may be overstated by up to %d" % (
+                len(dll_dictionary), dll_dictionary.max_error())
+
+    def cmdline_batches(self, q, start=0):
+        """
+        stream the command lines of every process matching the query,
+        beginning with the start'th result, batch_size command lines at
+        a time.  each batch is yielded along with the number of results
+        read up to the end of the batch
+        """
+        batch = []
+        while True:
+            procs = self.cb.process_search(q, start=start, rows=self.page_size)
+            if len(procs["results"]) == 0:
+                break
+
+            for result in procs["results"]:
+                start = start + 1
+                batch.append(result.get("cmdline", "<unknown>"))
+                if len(batch) >= self.batch_size:
+                    yield start, batch
+                    batch = []
+        if batch:
+            yield start, batch
+
+    def merge(self, cursor, keys):
+        """
+        add the matches from one batch of command lines to the per-regex
+        dictionaries, printing each match the first time it is seen.  with
+        more than one regex, each match is prefixed with its regex number.
+        cursor is the number of results read up to the end of the batch
+        """
+        for index, key in keys:
+            regex_match_dictionary = self.regex_match_dictionaries[index]
+
+            # Iterate TOTAL Search Match Count
+            self.search_match_counts[index] = self.search_match_counts[index] + 1
 
-    def check(self, regex, ignore_case, group_reference_to_match, count_flag, matches_only_flag):
-	    # CALLED BY: cb.check(opts.regex, opts.ignore_case, opts.group_reference_to_match, opts.count_flag, opts.matches_only_flag)
+            # On Match, add to dictionary
+            if regex_match_dictionary.add(key):
+                if len(self.regex_match_dictionaries) > 1:
+                    print "[%d] %s" % (index + 1, key)
+                else:
+                    print "%s" % (key)
+
+        self.cursor = cursor
+
+        # the counts and the cursor agree between batches, so this is the
+        # place to checkpoint
+        if self.checkpoint:
+            self.checkpoint.save(self.checkpoint_state())
+
+    def checkpoint_state(self):
+        return {"query": self.query,
+                "settings": self.matcher_args,
+                "cursor": self.cursor,
+                "regex_match_dictionaries": self.regex_match_dictionaries,
+                "search_match_counts": self.search_match_counts}
+
+    def check(self, regexes, ignore_case, group_reference_to_match, count_flag, matches_only_flag, full_scan=False, resume=False):
+        # CALLED BY: cb.check(regexes, opts.ignore_case, opts.group_reference_to_match, opts.count_flag, opts.matches_only_flag, opts.full_scan, opts.resume)
 
         # print a legend
-    	print ""
+        print ""
         print "Displaying Report for Commandline regular expression matches"
         print ""
-        print "Command Line Strings Matching REGEX: %s" % (regex)
+        for index, regex in enumerate(regexes):
+            if len(regexes) > 1:
+                print "[%d] Command Line Strings Matching REGEX: %s" % (index + 1, regex)
+            else:
+                print "Command Line Strings Matching REGEX: %s" % (regex)
         print "============================================================"
         print ""
 
-        # build the query string
-        q = "cmdline:*"
-
-        #define dictionary
-        regex_match_dictionary = dict()
-        search_match_count = 0
-        
-        #define regexp
-        # check if we need to ignore case, if so, update regexp
-        if ignore_case:
-            regexp = re.compile(regex, re.IGNORECASE)
+        # build the query string; the server narrows the search using the
+        # literals the regexes require, and the regexes themselves are still
+        # evaluated against every command line returned
+        if full_scan:
+            q = "cmdline:*"
         else:
-            regexp = re.compile(regex)
+            q = build_query(regexes)
+        print "Query: %s" % (q)
+        print ""
 
+        self.regex_match_dictionaries = [SpaceSavingCounter(self.max_entries) for regex in regexes]
+        self.search_match_counts = [0 for regex in regexes]
+        self.cursor = 0
 
-        for result in self.cb.process_search_iter(q):
-            cmdline = result.get("cmdline", "<unknown>")
-            # print "CMD: %s" % (cmdline,)
+        matcher_args = (regexes, ignore_case, group_reference_to_match, matches_only_flag)
+        self.query = q
+        self.matcher_args = matcher_args
 
-            #SEARCH FOR REGEX IN STRING!!
-            if matches_only_flag:
-                # print "-----MATCHES ONLY"
-                search_match_result = regexp.match(cmdline)
+        # pick up the counts and the position in the result set from the
+        # last checkpoint, provided it was taken for the same search
+        if resume:
+            state = self.checkpoint.load()
+            if state is None:
+                print "No checkpoint found in %s; starting from the beginning" % (self.checkpoint.filename)
+            elif state["query"] != q or state["settings"] != matcher_args:
+                print "Checkpoint %s was taken for a different search" % (self.checkpoint.filename)
+                sys.exit(-1)
             else:
-                # print "-----EVERYTHING"
-                search_match_result = regexp.search(cmdline)
-
-            if search_match_result is not None:
-                # print "cmdline: %s" % (cmdline)
-                # print "result: %s" % (search_match_result)
-                # print "------------------------------------"
-
-                # Iterate TOTAL Search Match Count
-                search_match_count = search_match_count + 1
-
-                # On Match, add to dictionary
-                # 1st Check group_reference_to_match flag to see if we need to add a specific Group Reference or just the entire Command Line as the regex match
-                if group_reference_to_match:
-                    # print "cmdline: %s" % (cmdline)
-                    # print"matching GROUP: %s" % (group_reference_to_match)
-                    # print"search_match_result: %s" % (search_match_result)
-                    regex_match_group_reference = search_match_result.group(int(group_reference_to_match))
-                    if regex_match_group_reference not in regex_match_dictionary.keys():
-                        print "%s" % (regex_match_group_reference)
-                        regex_match_dictionary[regex_match_group_reference] = 1
-                    else:
-                        regex_match_dictionary[regex_match_group_reference] = regex_match_dictionary[regex_match_group_reference] + 1
-                else:
-                    if cmdline not in regex_match_dictionary.keys():
-                        print "%s" % (cmdline)
-                        regex_match_dictionary[cmdline] = 1
-                    else:
-                        regex_match_dictionary[cmdline] = regex_match_dictionary[cmdline] + 1
+                self.cursor = state["cursor"]
+                self.regex_match_dictionaries = state["regex_match_dictionaries"]
+                self.search_match_counts = state["search_match_counts"]
+                print "Resuming from result %d" % (self.cursor)
+            print ""
 
-        self.report(regex, regex_match_dictionary, search_match_count)
+        if self.workers <= 1:
+            # evaluate each batch in this process, as it arrives
+            matcher = CmdlineMatcher(*matcher_args)
+            for cursor, batch in self.cmdline_batches(q, self.cursor):
+                self.merge(cursor, matcher.match_batch(batch))
+        else:
+            # this process pages through the search results while a pool
+            # of worker processes evaluates the regex on the batches.  no
+            # more than two batches per worker are outstanding at a time,
+            # and the results are merged in the order the batches were read
+            pool = multiprocessing.Pool(self.workers, init_worker, matcher_args)
+            try:
+                pending = collections.deque()
+                for cursor, batch in self.cmdline_batches(q, self.cursor):
+                    pending.append((cursor, pool.apply_async(match_batch, (batch,))))
+                    if len(pending) >= self.workers * 2:
+                        cursor, result = pending.popleft()
+                        self.merge(cursor, result.get())
+                while pending:
+                    cursor, result = pending.popleft()
+                    self.merge(cursor, result.get())
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        # the scan is complete; there is nothing left to resume
+        if self.checkpoint:
+            self.checkpoint.remove()
+
+        for index, regex in enumerate(regexes):
+            if len(regexes) > 1:
+                print ""
+                print "[%d] REGEX: %s" % (index + 1, regex)
+            self.report(regex, self.regex_match_dictionaries[index], self.search_match_counts[index])
 
 def build_cli_parser():
     parser = OptionParser(usage="%prog [options]", description="Parse the command line using a regular expression (includes the options to count matches & leverage reference groups to define output). NOTE: Given that this script parses all command line data stored in Carbon Black, this script can take from several minutes to several hours to run depending upon the size of your Carbon Black ER datastore & the CbER server's hardware. It is reccomended to use output redirection as then you can tail as well as monitor the output file's size to check the status of long running queries.")
@@ -181,6 +458,12 @@ def build_cli_parser():
                       help="Do not verify server SSL certificate.")
     parser.add_option("-r", "--regex", action="store", default=None, dest="regex",
                       help="Regular Expression for parsing cmdline")
+    parser.add_option("-f", "--regex-file", action="store", default=None, dest="regex_file",
+                      help="File of newline delimited Regular Expressions; all are evaluated in a single pass " +
+                           "over the command lines, with a separate report for each")
+    parser.add_option("-F", "--full-scan", action="store_true", default=False, dest="full_scan",
+                      help="Evaluate the regex against every command line (cmdline:*) rather than only " +
+                           "those containing the literal text the regex requires")
     parser.add_option("-i", "--ignore-case", action="store", default=None, dest="ignore_case",
                       help="Flag to force regex to ignore character case when matching")
     parser.add_option("-G", "--group-reference-to-match", action="store", default=None, dest="group_reference_to_match",
@@ -189,6 +472,24 @@ def build_cli_parser():
                       help="Count instances of matched regex hits (in some cases, enabling this function may cause this script to run for a long time)")
     parser.add_option("-M", "--matches-only", action="store_true", default=False, dest="matches_only_flag",
                       help="Match MUST begin at the 1st character of the command line string (ASSUME ^ at start of regex)")
+    parser.add_option("-p", "--pagesize", action="store", default=100, dest="pagesize", type="int",
+                      help="Number of processes to retrieve during each search API invocation")
+    parser.add_option("-b", "--batch-size", action="store", default=1000, dest="batch_size", type="int",
+                      help="Number of command lines handed to a worker process at a time")
+    parser.add_option("-w", "--workers", action="store", default=1, dest="workers", type="int",
+                      help="Number of worker processes evaluating the regex; with more than one, " +
+                           "the server is paged in this process while the workers evaluate (default 1)")
+    parser.add_option("-k", "--checkpoint", action="store", default=None, dest="checkpoint",
+                      help="File to periodically save progress to, so that an interrupted run can be resumed")
+    parser.add_option("--checkpoint-interval", action="store", default=60, dest="checkpoint_interval", type="int",
+                      help="Minimum number of seconds between checkpoints (default 60)")
+    parser.add_option("-R", "--resume", action="store_true", default=False, dest="resume",
+                      help="Resume from the last checkpoint saved to the --checkpoint file")
+    parser.add_option("-m", "--max-entries", action="store", default=None, dest="max_entries", type="int",
+                      help="Keep at most this many distinct matches per regex, bounding memory use; the most " +
+                           "frequent matches are always kept but their counts become approximate")
+    parser.add_option("-T", "--top", action="store", default=None, dest="top", type="int",
+                      help="Only report the N most frequent matches")
 
 
     return parser
@@ -196,7 +497,7 @@ def build_cli_parser():
 def main(argv):
     parser = build_cli_parser()
     opts, args = parser.parse_args(argv)
-    if not opts.url or not opts.token or not opts.regex:
+    if not opts.url or not opts.token or not (opts.regex or opts.regex_file):
         print "Missing required param."
         sys.exit(-1)
     #If group_reference_to_match is specified, verify it is an integer
@@ -205,9 +506,43 @@ def main(argv):
             print "group-reference-to-match argument must be defined as an integer"
             sys.exit(-1)
 
-    cb = CBQuery(opts.url, opts.token, ssl_verify=opts.ssl_verify)
+    if opts.pagesize < 1 or opts.batch_size < 1 or opts.workers < 1:
+        print "The page size, batch size and number of workers must be at least 1"
+        sys.exit(-1)
+    if (opts.max_entries is not None and opts.max_entries < 1) or (opts.top is not None and opts.top < 1):
+        print "The maximum number of entries and the number of top matches must be at least 1"
+        sys.exit(-1)
+    if opts.resume and not opts.checkpoint:
+        print "--resume requires a --checkpoint file"
+        sys.exit(-1)
+
+    checkpoint = None
+    if opts.checkpoint:
+        checkpoint = Checkpoint(opts.checkpoint, opts.checkpoint_interval)
+
+    cb = CBQuery(opts.url, opts.token, ssl_verify=opts.ssl_verify,
+                 page_size=opts.pagesize, batch_size=opts.batch_size, workers=opts.workers,
+                 checkpoint=checkpoint, max_entries=opts.max_entries, top=opts.top)
+
+    # gather the regexes, dropping blank lines and duplicates
+    regexes = []
+    if opts.regex:
+        regexes.append(opts.regex)
+    if opts.regex_file:
+        for line in open(opts.regex_file, "r"):
+            line = line.strip()
+            if len(line) == 0 or line in regexes:
+                continue
+            regexes.append(line)
+
+    for regex in regexes:
+        try:
+            re.compile(regex)
+        except re.error, e:
+            print "Invalid regular expression %s: %s" % (regex, e)
+            sys.exit(-1)
 
-    cb.check(opts.regex, opts.ignore_case, opts.group_reference_to_match, opts.count_flag, opts.matches_only_flag)
+    cb.check(regexes, opts.ignore_case, opts.group_reference_to_match, opts.count_flag, opts.matches_only_flag, opts.full_scan, opts.resume)
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv[1:]))
@@ -56,11 +56,17 @@ import socket
 from optparse import OptionParser
 from cbapi import CbApi
 
+from counter_helpers import SpaceSavingCounter
+
 class CBQuery(object):
-    def __init__(self, url, token, ssl_verify):
+    def __init__(self, url, token, ssl_verify, max_entries=None):
         self.cb = CbApi(url, token=token, ssl_verify=ssl_verify)
         self.cb_url = url
 
+        # with max_entries, at most that many distinct usernames are kept,
+        # and counts become approximate (see counter_helpers)
+        self.max_entries = max_entries
+
     def report(self, hostname, user_dictionary):
         print ""
         print "%s | %s : %s" % ("Hostname", "Process Count", "Username")
@@ -69,6 +75,11 @@ class CBQuery(object):
 	for key,value in user_dictionary.items():
 		print "%s | %s = %s" % (hostname, value, key)
 
+	if user_dictionary.max_error() > 0:
+		print "--------------------------------------------"
+		print "NOTE: only the %d most common usernames were kept; counts may be overstated by up to %d" % (
+			len(user_dictionary), user_dictionary.max_error())
+
     def check(self, hostname):
         # print a legend
 	print ""
@@ -79,17 +90,14 @@ class CBQuery(object):
         q = "hostname:%s" % (hostname)
       
 	#define dictionary
-	user_dictionary = dict()
+	user_dictionary = SpaceSavingCounter(self.max_entries)
  
 	# loop over the entire result set
         for result in self.cb.process_search_iter(q):
 		user_name = result.get("username", "<unknown>")
 
-		if user_name not in user_dictionary.keys():
+		if user_dictionary.add(user_name):
 			print "NEW USER found on %s : %s" % (hostname, user_name)
-			user_dictionary[user_name] = 1
-		else:
-			user_dictionary[user_name] = user_dictionary[user_name] + 1
 
 	self.report(hostname, user_dictionary)
 
@@ -105,6 +113,9 @@ def build_cli_parser():
                       help="Do not verify server SSL certificate.")
     parser.add_option("-H", "--hostname", action="store", default=None, dest="hostname",
                       help="Endpoint hostname to query for network traffic")
+    parser.add_option("-m", "--max-entries", action="store", default=None, dest="max_entries", type="int",
+                      help="Keep at most this many distinct usernames, bounding memory use; the most " +
+                           "common usernames are always kept but their counts become approximate")
     return parser
 
 def main(argv):
@@ -114,7 +125,11 @@ def main(argv):
         print "Missing required param."
         sys.exit(-1)
 
-    cb = CBQuery(opts.url, opts.token, ssl_verify=opts.ssl_verify)
+    if opts.max_entries is not None and opts.max_entries < 1:
+        print "The maximum number of entries must be at least 1"
+        sys.exit(-1)
+
+    cb = CBQuery(opts.url, opts.token, ssl_verify=opts.ssl_verify, max_entries=opts.max_entries)
 
     cb.check(opts.hostname)
 
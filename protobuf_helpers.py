@@ -0,0 +1,164 @@
+#
+#The MIT License (MIT)
+#
+# Copyright (c) 2016 Carbon Black
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# -----------------------------------------------------------------------------
+#  Protobuf wire format helpers
+#
+#  The ingress.event.* consumers throw away most of the messages they receive,
+#  e.g. every regmod or filemod event that isn't a modification.  Decoding a
+#  whole CbEventMsg with the pure Python protobuf library is slow, so these
+#  helpers read just the few fields needed to decide whether a message is
+#  wanted straight from the wire format, and skip over everything else.
+#
+#  See https://developers.google.com/protocol-buffers/docs/encoding and
+#  sensor_events.proto for the field numbers.
+#
+
+# CbEventMsg fields
+CBEVENTMSG_FILEMOD = 5
+CBEVENTMSG_REGMOD = 7
+
+# CbFileModMsg.action and CbRegModMsg.action
+MODMSG_ACTION = 2
+MODMSG_ACTION_DEFAULT = 1
+
+WIRETYPE_VARINT = 0
+WIRETYPE_FIXED64 = 1
+WIRETYPE_LENGTH_DELIMITED = 2
+WIRETYPE_FIXED32 = 5
+
+
+def read_varint(body, pos):
+    """
+    Return the varint at pos, and the position after it.
+    """
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(body):
+            raise ValueError("truncated varint")
+        byte = ord(body[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_fields(body, start=0, end=None):
+    """
+    Yield (field number, wire type, value) for the fields of the message in
+    body[start:end].  The value of a varint is the integer; the value of a
+    length-delimited field is its (start, end) within body; other values are
+    None.  Raises ValueError for anything else, e.g. groups.
+    """
+    if end is None:
+        end = len(body)
+
+    pos = start
+    while pos < end:
+        key, pos = read_varint(body, pos)
+        field_number = key >> 3
+        wire_type = key & 0x7
+
+        if wire_type == WIRETYPE_VARINT:
+            value, pos = read_varint(body, pos)
+        elif wire_type == WIRETYPE_LENGTH_DELIMITED:
+            length, pos = read_varint(body, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == WIRETYPE_FIXED64:
+            value = None
+            pos += 8
+        elif wire_type == WIRETYPE_FIXED32:
+            value = None
+            pos += 4
+        else:
+            raise ValueError("unsupported wire type %d" % wire_type)
+
+        if pos > end:
+            raise ValueError("truncated field %d" % field_number)
+        yield field_number, wire_type, value
+
+
+def mod_action(body, event_field):
+    """
+    Return the action of the CbFileModMsg or CbRegModMsg in the serialized
+    CbEventMsg (event_field is CBEVENTMSG_FILEMOD or CBEVENTMSG_REGMOD), or
+    None if the message has no such event.  Raises ValueError if the message
+    can't be read this way; a full parse should decide those.
+    """
+    event_key = (event_field << 3) | WIRETYPE_LENGTH_DELIMITED
+    action = None
+    end = len(body)
+    pos = 0
+
+    # the top level fields are skipped over inline, as most messages have
+    # many of them (one per string) and no event of the wanted type
+    while pos < end:
+        key = ord(body[pos])
+        if key & 0x80:
+            key, pos = read_varint(body, pos)
+        else:
+            pos += 1
+
+        wire_type = key & 0x7
+        if wire_type == WIRETYPE_LENGTH_DELIMITED:
+            length = ord(body[pos]) if pos < end else 0x80
+            if length & 0x80:
+                length, pos = read_varint(body, pos)
+            else:
+                pos += 1
+
+            if key == event_key:
+                # as when parsing, a repeated submessage is merged, so the
+                # last action seen wins
+                if action is None:
+                    action = MODMSG_ACTION_DEFAULT
+                for field_number, sub_wire_type, value in iter_fields(body, pos, pos + length):
+                    if field_number == MODMSG_ACTION and sub_wire_type == WIRETYPE_VARINT:
+                        action = value
+            pos += length
+        elif wire_type == WIRETYPE_VARINT:
+            value, pos = read_varint(body, pos)
+        elif wire_type == WIRETYPE_FIXED64:
+            pos += 8
+        elif wire_type == WIRETYPE_FIXED32:
+            pos += 4
+        else:
+            raise ValueError("unsupported wire type %d" % wire_type)
+
+    if pos > end:
+        raise ValueError("truncated message")
+    return action
+
+
+def may_have_mod_action(body, event_field, wanted_action):
+    """
+    Return False if the serialized CbEventMsg certainly doesn't carry the
+    given event with the wanted action, and so needn't be parsed.
+    """
+    try:
+        return mod_action(body, event_field) == wanted_action
+    except ValueError:
+        return True
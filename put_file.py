@@ -1,26 +1,26 @@
 try:
     from cbapi.legacy.util.cli_helpers import main_helper
-    from cbapi.legacy.util.live_response_helpers import LiveResponseHelper
 except ImportError:
     from cbapi.util.cli_helpers import main_helper
-    from cbapi.util.live_response_helpers import LiveResponseHelper
+
+import lr_fleet_helpers
 
 def main(cb, args):
     lfile = args.get('lfile')
     rfile = args.get('rfile')
-    sensor_id = int(args.get('sensorid'))
-    lrh = LiveResponseHelper(cb, sensor_id)
-    lrh.start()
-    
+
+    def put_file(lrh, sensor):
+        return lrh.put_file(rfile, lfile)
+
+    def report(sensor, results):
+        print "[+] %s: %s" % (lr_fleet_helpers.describe(sensor),
+                              ", ".join(i + ' = ' + str(results[i]) for i in results))
+
     print "[*] Attempting to upload file: %s" % lfile
-    results = lrh.put_file(rfile, lfile)
-    print "\n[+] Results:\n============"
-    for i in results:
-        print i + ' = ' + str(results[i])
-    lrh.stop()
+    lr_fleet_helpers.run_on_sensors(cb, args, put_file, report)
 
 if __name__ == "__main__":
-    sensor_arg = ("-s", "--sensorid", "store", None, "sensorid", "Sensor id")
     lfile_arg = ("-l", "--localfile", "store", None, "lfile", "Local File Path")
     rfile_arg = ("-r", "--remotefile", "store", None, "rfile", "Remote File Path")
-    main_helper("Place a file on remote sensor", main, custom_required=[sensor_arg, lfile_arg, rfile_arg])
+    main_helper("Place a file on remote sensors", main, custom_required=[lfile_arg, rfile_arg],
+                custom_optional=lr_fleet_helpers.FLEET_OPTIONS)
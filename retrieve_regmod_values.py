@@ -41,9 +41,12 @@
 #
 
 import re
+import sre_parse
+import sre_constants
 import Queue
 import sys
-from threading import Thread
+from collections import deque
+from threading import Thread, Lock
 import time
 import traceback
 
@@ -56,6 +59,82 @@ except ImportError:
     from cbapi.util.composite_helpers import MessageSubscriberAndLiveResponseActor
     import cbapi.util.sensor_events_pb2 as cpb
 
+import protobuf_helpers
+
+def literal_prefix(regex):
+    """
+    Return the literal string that every match of the regex starts with,
+    e.g. "\\registry\\user\\" for \\registry\\user\\(.*)\\software.
+    Case-insensitive regexes have no literal prefix.
+    """
+    parsed = sre_parse.parse(regex)
+    if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return ""
+
+    prefix = []
+    for op, av in parsed:
+        if op != sre_constants.LITERAL:
+            break
+        prefix.append(unichr(av))
+    return "".join(prefix)
+
+class RegpathNode(object):
+    def __init__(self):
+        # path component -> RegpathNode
+        self.children = {}
+        # (start of the next path component, pattern index, compiled regex)
+        # for each regex whose literal prefix ends below this node
+        self.tails = []
+
+class RegpathMatcher(object):
+    """
+    Matches registry paths against the regexes of a regpaths file.
+
+    Duplicate regexes are dropped, and each regex is filed in a trie of
+    registry path components under its literal prefix, so a path is only
+    tried against the few regexes whose prefix it starts with, rather than
+    against every regex.
+    """
+    def __init__(self, regexes):
+        self.regexes = []
+        self.root = RegpathNode()
+
+        for regex in regexes:
+            if regex in self.regexes:
+                continue
+            index = len(self.regexes)
+            self.regexes.append(regex)
+
+            components = literal_prefix(regex).split("\\")
+            node = self.root
+            for component in components[:-1]:
+                node = node.children.setdefault(component, RegpathNode())
+            node.tails.append((components[-1], index, re.compile(regex)))
+
+    def __len__(self):
+        return len(self.regexes)
+
+    def match(self, regpath):
+        """
+        Return True if any of the regexes matches the start of the path.
+        """
+        candidates = []
+        node = self.root
+        for component in regpath.split("\\"):
+            for tail, index, regex in node.tails:
+                if component.startswith(tail):
+                    candidates.append((index, regex))
+            node = node.children.get(component)
+            if node is None:
+                break
+
+        # try them in the order of the file, as before
+        candidates.sort(key=lambda candidate: candidate[0])
+        for index, regex in candidates:
+            if regex.match(regpath):
+                return True
+        return False
+
 class RegistryModWatcherAndValueGrabber(MessageSubscriberAndLiveResponseActor):
     """
     This class subscribes to messages from the CB messaging bus,
@@ -63,9 +142,15 @@ class RegistryModWatcherAndValueGrabber(MessageSubscriberAndLiveResponseActor):
     to see if the the registry path matches one of our regexes.
     If it does, it goes and grabs it.
     """
-    def __init__(self, cb_server_url, cb_ext_api, username, password, regmod_regexes, verbose):
-        self.regmod_regexes = regmod_regexes
+    def __init__(self, cb_server_url, cb_ext_api, username, password, regmod_matcher, verbose, workers=10,
+                 max_per_sensor=100, dedupe_window=60, max_sessions=50, session_idle_timeout=300, session_timeout=120):
+        self.regmod_matcher = regmod_matcher
         self.verbose = verbose
+        self.max_per_sensor = max_per_sensor
+        self.dedupe_window = dedupe_window
+        self.max_sessions = max_sessions
+        self.session_idle_timeout = session_idle_timeout
+        self.session_timeout = session_timeout
         MessageSubscriberAndLiveResponseActor.__init__(self,
                                                        cb_server_url,
                                                        cb_ext_api,
@@ -73,15 +158,36 @@ class RegistryModWatcherAndValueGrabber(MessageSubscriberAndLiveResponseActor):
                                                        password,
                                                        "ingress.event.regmod")
 
-        # Threading so that message queue arrives do not block waiting for live response
-        self.queue = Queue.Queue()
+        # Threading so that message queue arrives do not block waiting for live response.
+        #
+        # Each sensor has its own bounded queue of registry values to fetch, and
+        # at most one worker serves a sensor at a time (a live response session
+        # runs one command at a time anyway), so a slow or offline sensor only
+        # ties up one worker while the others serve every other sensor.
+        self.lock = Lock()
+        self.pending_by_sensor_id = {}
+        self.ready_sensor_ids = Queue.Queue()
+        self.active_sensor_ids = set()
+
+        # (sensor id, regpath) -> time its value was last fetched, and the
+        # (sensor id, regpath) queued or being fetched now
+        self.recent_requests = {}
+        self.queued_requests = set()
+
+        # sensor id -> time its live response session was last used
+        self.lr_last_used = {}
+
         self.go = True
-        self.worker_thread = Thread(target=self._worker_thread_loop)
-        self.worker_thread.start()
+        self.worker_threads = []
+        for i in range(workers):
+            worker_thread = Thread(target=self._worker_thread_loop)
+            worker_thread.start()
+            self.worker_threads.append(worker_thread)
 
     def on_stop(self):
         self.go = False
-        self.worker_thread.join(timeout=2)
+        for worker_thread in self.worker_threads:
+            worker_thread.join(timeout=2)
         MessageSubscriberAndLiveResponseActor.on_stop(self)
 
     def consume_message(self, channel, method_frame, header_frame, body):
@@ -89,6 +195,11 @@ class RegistryModWatcherAndValueGrabber(MessageSubscriberAndLiveResponseActor):
             return
 
         try:
+            # Most messages aren't modifications, so check that from the raw
+            # message before paying for a full parse
+            if not protobuf_helpers.may_have_mod_action(body, protobuf_helpers.CBEVENTMSG_REGMOD, 2):
+                return
+
             # NOTE -- this is not very efficient in PYTHON, and should
             # use a C parser to make this much, much faster.
             # http://yz.mit.edu/wp/fast-native-c-protocol-buffers-from-python/
@@ -105,10 +216,8 @@ class RegistryModWatcherAndValueGrabber(MessageSubscriberAndLiveResponseActor):
             if x.regmod.utf8_regpath:
                 if self.verbose:
                     print "Event arrived: |%s|" % x.regmod.utf8_regpath
-                for regmod_regex in self.regmod_regexes:
-                    if regmod_regex.match(x.regmod.utf8_regpath):
-                        regmod_path = x.regmod.utf8_regpath
-                        break
+                if self.regmod_matcher.match(x.regmod.utf8_regpath):
+                    regmod_path = x.regmod.utf8_regpath
 
             if regmod_path:
                 regmod_path = regmod_path.replace("\\registry\\machine\\", "HKLM\\")
@@ -116,45 +225,155 @@ class RegistryModWatcherAndValueGrabber(MessageSubscriberAndLiveResponseActor):
                 regmod_path = regmod_path.strip()
                 # TODO -- more cleanup here potentially?
 
-                self.queue.put((x, regmod_path))
+                self._queue_request(x, regmod_path)
 
         except:
             traceback.print_exc()
 
+    def _queue_request(self, x, regmod_path):
+        """
+        Queue the value for its sensor, unless the same (sensor, regpath) is
+        already queued, was fetched within the dedupe window, or the sensor's
+        queue is full.
+        """
+        sensor_id = x.env.endpoint.SensorId
+        now = time.time()
+
+        with self.lock:
+            key = (sensor_id, regmod_path)
+            if key in self.queued_requests:
+                return
+            last = self.recent_requests.get(key)
+            if last is not None and now - last < self.dedupe_window:
+                return
+
+            if len(self.recent_requests) > 100000:
+                # forget the requests that have left the window
+                for old_key, old_time in self.recent_requests.items():
+                    if now - old_time >= self.dedupe_window:
+                        del self.recent_requests[old_key]
+
+            pending = self.pending_by_sensor_id.setdefault(sensor_id, deque())
+            if len(pending) >= self.max_per_sensor:
+                print "--> Dropping %s, too many values already queued for sensor %d" % (regmod_path, sensor_id)
+                return
+            pending.append((x, regmod_path))
+            self.queued_requests.add(key)
+
+            if sensor_id not in self.active_sensor_ids:
+                self.active_sensor_ids.add(sensor_id)
+                self.ready_sensor_ids.put(sensor_id)
+
     def _worker_thread_loop(self):
         while self.go:
             try:
                 try:
-                    (x, regmod_path) = self.queue.get(timeout=0.5)
+                    sensor_id = self.ready_sensor_ids.get(timeout=0.5)
                 except Queue.Empty:
+                    self._close_idle_lr_sessions()
                     continue
 
-                # TODO -- could comment this out if you want CSV data to feed into something
-                print "--> Attempting for %s" % regmod_path
+                with self.lock:
+                    (x, regmod_path) = self.pending_by_sensor_id[sensor_id].popleft()
+
+                fetched = False
+                try:
+                    fetched = self._grab_value(x, regmod_path)
+                finally:
+                    # take turns with the other sensors rather than draining this one
+                    with self.lock:
+                        # only a value actually fetched holds off repeats for
+                        # the dedupe window
+                        self.queued_requests.discard((sensor_id, regmod_path))
+                        if fetched:
+                            self.recent_requests[(sensor_id, regmod_path)] = time.time()
+                        self.lr_last_used[sensor_id] = time.time()
+                        if self.pending_by_sensor_id[sensor_id]:
+                            self.ready_sensor_ids.put(sensor_id)
+                        else:
+                            del self.pending_by_sensor_id[sensor_id]
+                            self.active_sensor_ids.discard(sensor_id)
+            except:
+                traceback.print_exc()
+
+    def _grab_value(self, x, regmod_path):
+        """
+        Fetch and print the value.  Returns False if the sensor's live
+        response session was not ready in time.
+        """
+        # TODO -- could comment this out if you want CSV data to feed into something
+        print "--> Attempting for %s" % regmod_path
 
-                # Go Grab it if we think we have something!
-                sensor_id = x.env.endpoint.SensorId
-                hostname = x.env.endpoint.SensorHostName
+        # Go Grab it if we think we have something!
+        sensor_id = x.env.endpoint.SensorId
+        hostname = x.env.endpoint.SensorHostName
 
-                # TODO -- this could use some concurrency and work queues because we could wait a while for
-                # each of these to get established and retrieve the value
+        # Establish our CBLR session if necessary!  Sessions are kept open and
+        # reused until they have been idle for a while, and opening one past
+        # the maximum closes the least recently used idle one.
+        with self.lock:
+            if sensor_id not in self.lr_sessions_by_sensor_id:
+                self._make_room_for_lr_session()
+            lrh = self._create_lr_session_if_necessary(sensor_id)
+            self.lr_last_used[sensor_id] = time.time()
 
-                # Establish our CBLR session if necessary!
-                lrh = self._create_lr_session_if_necessary(sensor_id)
+        # don't wait forever on a sensor that is offline; the session keeps
+        # trying in the background for the sensor's next value
+        if not lrh.ready_event.wait(self.session_timeout):
+            print "--> Live response session for sensor %d not ready, skipping %s" % (sensor_id, regmod_path)
+            return False
 
-                data = lrh.get_registry_value(regmod_path)
+        data = lrh.get_registry_value(regmod_path)
 
-                print "%s,%s,%d,%s,%s,%s" % ( time.asctime(),
-                                              hostname,
-                                              sensor_id,
-                                              x.header.process_path,
-                                              regmod_path,
-                                              data.get('value_data', "") if data else "<UNKNOWN>")
+        print "%s,%s,%d,%s,%s,%s" % ( time.asctime(),
+                                      hostname,
+                                      sensor_id,
+                                      x.header.process_path,
+                                      regmod_path,
+                                      data.get('value_data', "") if data else "<UNKNOWN>")
 
-                # TODO -- could *do something* here, like if it is for autoruns keys then go check the signature status
-                # of the binary at the path pointed to, and see who wrote it out, etc
-            except:
-                traceback.print_exc()
+        # TODO -- could *do something* here, like if it is for autoruns keys then go check the signature status
+        # of the binary at the path pointed to, and see who wrote it out, etc
+        return True
+
+    def _close_idle_lr_sessions(self):
+        """
+        Stop the live response sessions idle for longer than the idle timeout,
+        and the least recently used idle ones beyond the maximum number of
+        sessions.
+        """
+        now = time.time()
+        with self.lock:
+            idle = sorted((last_used, sensor_id) for sensor_id, last_used in self.lr_last_used.items()
+                          if sensor_id not in self.active_sensor_ids)
+            excess = len(self.lr_last_used) - self.max_sessions
+
+            for last_used, sensor_id in idle:
+                if now - last_used < self.session_idle_timeout and excess <= 0:
+                    break
+                self._close_lr_session(sensor_id)
+                excess -= 1
+
+    def _make_room_for_lr_session(self):
+        """
+        Stop the least recently used idle sessions, if there are already
+        the maximum number of sessions open.  Called with the lock held.
+        """
+        excess = len(self.lr_sessions_by_sensor_id) - self.max_sessions + 1
+        if excess <= 0:
+            return
+
+        idle = sorted((last_used, sensor_id) for sensor_id, last_used in self.lr_last_used.items()
+                      if sensor_id not in self.active_sensor_ids)
+        for last_used, sensor_id in idle[:excess]:
+            self._close_lr_session(sensor_id)
+
+    def _close_lr_session(self, sensor_id):
+        # called with the lock held
+        lrh = self.lr_sessions_by_sensor_id.pop(sensor_id, None)
+        self.lr_last_used.pop(sensor_id, None)
+        if lrh:
+            lrh.stop(wait=False)
 
 
 def main(cb, args):
@@ -174,16 +393,30 @@ def main(cb, args):
         line = line.strip()
         if len(line) == 0:
             continue
-        regmod_regexes.append(re.compile(line))
+        regmod_regexes.append(line)
+    regmod_matcher = RegpathMatcher(regmod_regexes)
+    if len(regmod_matcher) < len(regmod_regexes):
+        print "Ignoring %d duplicate regexes" % (len(regmod_regexes) - len(regmod_matcher))
 
+    # every worker may be using a session, and a new one is opened by
+    # closing an idle one
+    if int(args.get("max_sessions")) < int(args.get("workers")):
+        print "The maximum number of live response sessions must be at least the number of workers"
+        sys.exit(-1)
 
-    listener = RegistryModWatcherAndValueGrabber(args.get('server_url'), cb, username, password, regmod_regexes, verbose)
+    listener = RegistryModWatcherAndValueGrabber(args.get('server_url'), cb, username, password, regmod_matcher, verbose,
+                                                 workers=int(args.get("workers")),
+                                                 max_per_sensor=int(args.get("max_per_sensor")),
+                                                 dedupe_window=int(args.get("dedupe_window")),
+                                                 max_sessions=int(args.get("max_sessions")),
+                                                 session_idle_timeout=int(args.get("session_idle_timeout")),
+                                                 session_timeout=int(args.get("session_timeout")))
 
     try:
         if verbose:
             print "Registry Mod Watcher and Grabber -- started.  Watching for:", regpaths_data
         else:
-            print "Registry Mod Watcher and Grabber -- started. Watching for %d regexes" % len(regmod_regexes)
+            print "Registry Mod Watcher and Grabber -- started. Watching for %d regexes" % len(regmod_matcher)
 
         listener.process()
     except KeyboardInterrupt:
@@ -198,7 +431,18 @@ if __name__ == "__main__":
     required_args =[("-i", "--username", "store", None, "username", "CB messaging username"),
                     ("-p", "--password", "store", None, "password", "CB messaging password"),
                     ("-r", "--regpaths_file", "store", None, "regpaths_file", "File of newline delimited regexes for regpaths")]
-    optional_args = [("-v", "--verbose", "store_true", False, "verbose", "Enable verbose output")]
+    optional_args = [("-v", "--verbose", "store_true", False, "verbose", "Enable verbose output"),
+                     ("-w", "--workers", "store", 10, "workers", "Number of sensors to retrieve values from at once"),
+                     ("-q", "--max-per-sensor", "store", 100, "max_per_sensor",
+                      "Most values queued for one sensor; more are dropped"),
+                     ("-d", "--dedupe-window", "store", 60, "dedupe_window",
+                      "Seconds within which a repeat modification of the same value on a sensor is ignored"),
+                     ("-s", "--max-sessions", "store", 50, "max_sessions",
+                      "Most live response sessions to keep open; at least the number of workers"),
+                     ("-l", "--session-idle-timeout", "store", 300, "session_idle_timeout",
+                      "Seconds before an idle live response session is closed"),
+                     ("-t", "--session-timeout", "store", 120, "session_timeout",
+                      "Seconds to wait for a live response session to a sensor before skipping a value")]
     main_helper("Subscribe to message bus events and for each registry modification that matches one of our supplied regexes, go retrieve value.",
                 main,
                 custom_required=required_args,
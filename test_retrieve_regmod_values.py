@@ -0,0 +1,53 @@
+import unittest
+from threading import Lock
+
+from retrieve_regmod_values import RegistryModWatcherAndValueGrabber
+
+
+class FakeLiveResponseHelper(object):
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self, wait=True):
+        self.stopped = True
+
+
+class MakeRoomForLrSessionTest(unittest.TestCase):
+    def make_grabber(self, open_sessions, max_sessions, active_sensor_ids=()):
+        # skip __init__, which connects to the message bus
+        grabber = RegistryModWatcherAndValueGrabber.__new__(RegistryModWatcherAndValueGrabber)
+        grabber.lock = Lock()
+        grabber.max_sessions = max_sessions
+        grabber.active_sensor_ids = set(active_sensor_ids)
+        grabber.lr_sessions_by_sensor_id = {}
+        grabber.lr_last_used = {}
+        for sensor_id in range(open_sessions):
+            grabber.lr_sessions_by_sensor_id[sensor_id] = FakeLiveResponseHelper()
+            # sensor 0 was used longest ago
+            grabber.lr_last_used[sensor_id] = 1000.0 + sensor_id
+        return grabber
+
+    def test_under_cap_closes_nothing(self):
+        grabber = self.make_grabber(open_sessions=30, max_sessions=50)
+        sessions = dict(grabber.lr_sessions_by_sensor_id)
+
+        grabber._make_room_for_lr_session()
+
+        self.assertEqual(sorted(grabber.lr_sessions_by_sensor_id), range(30))
+        self.assertEqual(len(grabber.lr_last_used), 30)
+        self.assertFalse(any(lrh.stopped for lrh in sessions.values()))
+
+    def test_at_cap_closes_least_recently_used_idle_session(self):
+        # sensor 0 is the least recently used, but is busy
+        grabber = self.make_grabber(open_sessions=50, max_sessions=50, active_sensor_ids=[0])
+        sessions = dict(grabber.lr_sessions_by_sensor_id)
+
+        grabber._make_room_for_lr_session()
+
+        self.assertEqual(sorted(grabber.lr_sessions_by_sensor_id), [0] + range(2, 50))
+        self.assertNotIn(1, grabber.lr_last_used)
+        self.assertEqual([sensor_id for sensor_id, lrh in sessions.items() if lrh.stopped], [1])
+
+
+if __name__ == '__main__':
+    unittest.main()